@@ -0,0 +1,254 @@
+import uuid
+import json
+import asyncio
+
+# Custom imports
+try:
+    from .workflow import WorkflowJob, encode_prompt
+    from .uploads import UploadIndex, upload_name, local_images, replace_images
+    from .utils.lazy import lazy_import
+except ImportError:
+    from workflow import WorkflowJob, encode_prompt
+    from uploads import UploadIndex, upload_name, local_images, replace_images
+    from utils.lazy import lazy_import
+
+# Web related, imported on first use
+aiohttp = lazy_import("aiohttp")
+
+# Prompts not queued through this client whose events are kept in case someone
+# monitors them, and finished prompts whose late events are ignored. Prompts queued
+# with `queue_prompt` keep their events until they are monitored, however many.
+MAX_UNCLAIMED_PROMPTS = 1024
+MAX_FINISHED_PROMPTS = 1024
+
+
+class AsyncClient:
+    """
+    asyncio counterpart of `Client`. A single background task reads the websocket and
+    routes every message that carries a `prompt_id` (executing, progress, executed, ...)
+    to that prompt's event queue, so one event loop can drive many prompts and many
+    servers at once.
+    """
+
+    def __init__(
+        self,
+        server_address: str,
+        client_id: str = None,
+        log: bool = True,
+        upload_index: UploadIndex = None,
+    ):
+        self.server_address = server_address
+        if client_id == None:
+            self.client_id = str(uuid.uuid4())
+        else:
+            self.client_id = str(client_id)
+        self.log = log
+        self.session = None
+        self.connection = None
+        self._reader = None
+        self._events = {}
+        self._queued = set()
+        self._unclaimed = {}
+        self._dropped = {}
+        self._finished = {}
+        self.queue_remaining = 0
+        self.upload_index = upload_index if upload_index != None else UploadIndex()
+
+    async def connect(self):
+        if self.connection == None:
+            if self.session == None:
+                self.session = aiohttp.ClientSession()
+            self.connection = await self.session.ws_connect(
+                f"ws://{self.server_address}/ws?clientId={self.client_id}",
+                max_msg_size=0,
+            )
+            self._reader = asyncio.create_task(self._read_messages())
+            if self.log:
+                print(f"Connected to client...")
+
+    async def close(self):
+        if self.connection != None:
+            await self.connection.close()
+        if self._reader != None:
+            await self._reader
+            self._reader = None
+        if self.session != None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def queue_prompt(self, prompt):
+        data = encode_prompt(prompt, self.client_id)
+        async with self.session.post(
+            f"http://{self.server_address}/prompt", data=data
+        ) as response:
+            response.raise_for_status()
+            result = json.loads(await response.read())
+        # Register before returning so no early event for this prompt is dropped.
+        self._event_queue(result["prompt_id"])
+        self._queued.add(result["prompt_id"])
+        self._unclaimed.pop(result["prompt_id"], None)
+        if self.log:
+            print(f"Prompt queued")
+        return result
+
+    async def get_history(self, prompt_id):
+        async with self.session.get(
+            f"http://{self.server_address}/history/{prompt_id}"
+        ) as response:
+            response.raise_for_status()
+            return json.loads(await response.read())
+
+    async def get_image(self, filename, subfolder, folder_type):
+        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        async with self.session.get(
+            f"http://{self.server_address}/view", params=data
+        ) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def stream_image(
+        self, filename, subfolder, folder_type, chunk_size: int = 1 << 20
+    ):
+        """
+        Same as `get_image` but yields the file in chunks of `chunk_size` bytes.
+        """
+        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        async with self.session.get(
+            f"http://{self.server_address}/view", params=data
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def upload_image(self, image_path: str, subfolder: str = "") -> str:
+        """
+        Upload a local image to the server's input directory, unless an image with the
+        same content has already been uploaded there.
+
+        Returns
+        -------
+        str
+            Value to use for a LoadImage node's `image` input.
+        """
+        digest = await asyncio.to_thread(self.upload_index.file_hash, image_path)
+        name = self.upload_index.get(self.server_address, digest)
+        if name != None:
+            return name
+        with open(image_path, "rb") as f:
+            content = await asyncio.to_thread(f.read)
+        form = aiohttp.FormData()
+        form.add_field("type", "input")
+        form.add_field("subfolder", subfolder)
+        form.add_field("overwrite", "true")
+        form.add_field("image", content, filename=upload_name(image_path, digest))
+        async with self.session.post(
+            f"http://{self.server_address}/upload/image", data=form
+        ) as response:
+            response.raise_for_status()
+            result = json.loads(await response.read())
+        name = result["name"]
+        if result.get("subfolder"):
+            name = f"{result['subfolder']}/{name}"
+        self.upload_index.add(self.server_address, digest, name)
+        if self.log:
+            print(f"Uploaded {image_path} as {name}")
+        return name
+
+    async def upload_inputs(self, workflow_data: dict | WorkflowJob):
+        """
+        Upload every local image referenced by a LoadImage node and return a workflow
+        that refers to the uploaded copies instead.
+        """
+        names = {
+            node_key: await self.upload_image(path)
+            for node_key, path in local_images(workflow_data)
+        }
+        if not names:
+            return workflow_data
+        return replace_images(workflow_data, names)
+
+    async def monitor(self, prompt_id: str, callback=None):
+        """
+        Wait until `prompt_id` finishes executing.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Id returned by `queue_prompt`.
+        callback : Callable[[dict], None], optional
+            Called with every websocket message for this prompt, by default None
+
+        Raises
+        ------
+        ConnectionError
+            If the websocket closes before the prompt finishes.
+        RuntimeError
+            If `prompt_id` was not queued through this client and its events were
+            dropped before it was monitored.
+        """
+        if prompt_id in self._dropped:
+            raise RuntimeError(f"Events of prompt {prompt_id} were dropped")
+        events = self._event_queue(prompt_id)
+        self._queued.discard(prompt_id)
+        self._unclaimed.pop(prompt_id, None)
+        try:
+            while True:
+                if events.empty() and (self._reader == None or self._reader.done()):
+                    raise ConnectionError(f"Not connected to {self.server_address}")
+                message = await events.get()
+                if isinstance(message, Exception):
+                    raise message
+                if callback != None:
+                    callback(message)
+                if message["type"] == "executing":
+                    if message["data"]["node"] is None:
+                        break  # Execution complete
+        finally:
+            self._events.pop(prompt_id, None)
+            self._finished[prompt_id] = True
+            if len(self._finished) > MAX_FINISHED_PROMPTS:
+                del self._finished[next(iter(self._finished))]
+
+    def _event_queue(self, prompt_id: str) -> asyncio.Queue:
+        if prompt_id not in self._events:
+            self._events[prompt_id] = asyncio.Queue()
+            if prompt_id not in self._queued:
+                # Events that may arrive before queue_prompt returns, or for prompts
+                # queued elsewhere. Only these are ever dropped.
+                self._unclaimed[prompt_id] = True
+                if len(self._unclaimed) > MAX_UNCLAIMED_PROMPTS:
+                    oldest = next(iter(self._unclaimed))
+                    del self._unclaimed[oldest]
+                    del self._events[oldest]
+                    self._dropped[oldest] = True
+                    if len(self._dropped) > MAX_FINISHED_PROMPTS:
+                        del self._dropped[next(iter(self._dropped))]
+        return self._events[prompt_id]
+
+    async def _read_messages(self):
+        try:
+            async for msg in self.connection:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    message = json.loads(msg.data)
+                    data = message.get("data")
+                    if message["type"] == "status":
+                        exec_info = data["status"]["exec_info"]
+                        self.queue_remaining = exec_info["queue_remaining"]
+                    if isinstance(data, dict) and data.get("prompt_id"):
+                        if data["prompt_id"] not in self._finished:
+                            self._event_queue(data["prompt_id"]).put_nowait(message)
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    break
+                # Binary data (preview images) is ignored
+        finally:
+            self.connection = None
+            error = ConnectionError(f"Lost connection to {self.server_address}")
+            for events in self._events.values():
+                events.put_nowait(error)
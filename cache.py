@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import hashlib
+import threading
+
+# Custom imports
+# Age after which an unfinished entry whose owner cannot be checked is abandoned.
+STALE_AFTER = 24 * 3600
+
+try:
+    from .workflow import WorkflowJob
+    from .uploads import UploadIndex, local_images
+    from .outputs import output_items
+except ImportError:
+    from workflow import WorkflowJob
+    from uploads import UploadIndex, local_images
+    from outputs import output_items
+
+
+class ResultCache:
+    """
+    Content-addressed store of prompt outputs.
+
+    A job's key is the SHA-256 of its fully edited workflow as canonical JSON, with the
+    path of every local input image replaced by the hash of the image's content. Jobs
+    with the same workflow, seed, prompts and input pixels therefore share a key no
+    matter where the images live.
+
+    Jobs whose seed is drawn at random are never cached, see `cacheable`.
+
+    Outputs reach the cache through `sink()`, which wraps the real output sink and
+    copies every downloaded file into a temporary directory private to this process.
+    `commit` writes `entry.json` and renames the directory into place, so several
+    processes can share a cache without seeing each other's partial entries. Entries
+    are evicted least-recently-used first once the cache grows past `max_bytes`.
+
+    Layout: `<cache_dir>/<key>/entry.json` plus the output files, and
+    `<cache_dir>/<key>.<host>.<pid>.<id>.part/` while a job is downloading.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 10 * 1024**3):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            Directory holding the cache, created if needed.
+        max_bytes : int, optional
+            Size above which the least recently used entries are evicted, by default 10 GiB
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._hasher = UploadIndex()
+        os.makedirs(cache_dir, exist_ok=True)
+        # key -> [size, last_used]
+        self._entries = {}
+        for key in os.listdir(cache_dir):
+            entry_path = os.path.join(cache_dir, key, "entry.json")
+            if os.path.isfile(entry_path):
+                with open(entry_path, "r", encoding="utf-8") as f:
+                    size = json.load(f)["size"]
+                self._entries[key] = [size, os.stat(entry_path).st_mtime]
+            elif self._is_stale(key):
+                # Downloads of a job that never finished.
+                shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+
+    def _is_stale(self, name: str) -> bool:
+        """
+        Whether the unfinished entry `name` was abandoned. Entries of a process on this
+        host are stale once that process is gone, all others after `STALE_AFTER`.
+        """
+        parts = name.split(".")
+        if len(parts) == 5 and parts[-1] == "part" and parts[1] == _HOST:
+            if os.name != "nt" and parts[2].isdigit():
+                return not _pid_alive(int(parts[2]))
+        try:
+            mtime = os.stat(os.path.join(self.cache_dir, name)).st_mtime
+        except FileNotFoundError:
+            return False
+        return time.time() - mtime > STALE_AFTER
+
+    @staticmethod
+    def cacheable(job) -> bool:
+        """
+        False for jobs created with a random seed (`seed=-1`): every run of those is
+        meant to produce new outputs, so they are neither served from nor stored in
+        the cache. Plain dicts carry their literal seed and are always cacheable.
+        """
+        if isinstance(job, WorkflowJob) and job.inputs != None:
+            return job.inputs.get("seed", -1) != -1
+        return True
+
+    def key(self, job) -> str:
+        graph = job.to_dict() if isinstance(job, WorkflowJob) else job
+        graph = dict(graph)
+        for node_key, path in local_images(job):
+            node = dict(graph[node_key])
+            node["inputs"] = dict(node["inputs"], image=self._hasher.file_hash(path))
+            graph[node_key] = node
+        canonical = json.dumps(graph, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """
+        Return the cached entry for `key` and count a hit, or None and count a miss.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry_dir = os.path.join(self.cache_dir, key)
+            with open(
+                os.path.join(entry_dir, "entry.json"), "r", encoding="utf-8"
+            ) as f:
+                entry = json.load(f)
+            now = time.time()
+            os.utime(os.path.join(entry_dir, "entry.json"), (now, now))
+            self._entries[key][1] = now
+            return entry
+
+    def replay(self, key: str, entry: dict, sink):
+        """
+        Send the files of a cached entry to `sink` as if they had just been downloaded.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        for node_id, items in entry["outputs"].items():
+            for item in items:
+                if not sink.download:
+                    continue
+                writer = sink.open(node_id, item)
+                try:
+                    path = os.path.join(entry_dir, self._file_name(item))
+                    with open(path, "rb") as f:
+                        for chunk in iter(lambda: f.read(sink.chunk_size), b""):
+                            writer.write(chunk)
+                    writer.close()
+                except BaseException:
+                    writer.abort()
+                    raise
+
+    def misses_only(self, jobs, sink):
+        """
+        Replay cached jobs into `sink` and yield the rest.
+        """
+        for job in jobs:
+            if not self.cacheable(job):
+                yield job
+                continue
+            key = self.key(job)
+            entry = self.get(key)
+            if entry == None:
+                yield job
+                continue
+            print(f"Cache hit: {job}")
+            self.replay(key, entry, sink)
+
+    def sink(self, inner, job):
+        """
+        Wrap `inner` so every file downloaded for `job` is also stored in the cache.
+        Files are always downloaded, even when `inner` would skip them. Returns `inner`
+        itself for jobs that are not `cacheable`.
+        """
+        if not self.cacheable(job):
+            return inner
+        key = self.key(job)
+        entry_dir = os.path.join(
+            self.cache_dir, f"{key}.{_HOST}.{os.getpid()}.{uuid.uuid4().hex}.part"
+        )
+        os.makedirs(entry_dir)
+        return _CachingSink(key, entry_dir, inner)
+
+    def commit(self, sink, history: dict):
+        """
+        Publish the entry downloaded through `sink` once all its outputs are stored.
+        Does nothing for sinks that were not created by `sink()`.
+        """
+        if not isinstance(sink, _CachingSink):
+            return
+        outputs = {}
+        size = 0
+        for node_id, node_output in history["outputs"].items():
+            outputs[node_id] = output_items(node_output)
+            for item in outputs[node_id]:
+                path = os.path.join(sink.entry_dir, self._file_name(item))
+                if not os.path.exists(path):
+                    self.discard(sink)
+                    return
+                size += os.path.getsize(path)
+        entry_path = os.path.join(sink.entry_dir, "entry.json")
+        with open(entry_path, "w", encoding="utf-8") as f:
+            json.dump({"outputs": outputs, "size": size}, f)
+        try:
+            os.rename(sink.entry_dir, os.path.join(self.cache_dir, sink.key))
+        except OSError:
+            # Another process committed the same job first.
+            self.discard(sink)
+            return
+        with self._lock:
+            self._entries[sink.key] = [size, time.time()]
+            self._evict()
+
+    def discard(self, sink):
+        """
+        Drop whatever was downloaded through `sink`, e.g. after a failed download.
+        """
+        if isinstance(sink, _CachingSink):
+            shutil.rmtree(sink.entry_dir, ignore_errors=True)
+
+    def _evict(self):
+        total = sum(size for size, _ in self._entries.values())
+        for key in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if total <= self.max_bytes:
+                break
+            total -= self._entries.pop(key)[0]
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+    def report(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": sum(size for size, _ in self._entries.values()),
+            }
+
+    @staticmethod
+    def _file_name(item: dict) -> str:
+        subfolder = item.get("subfolder", "").replace("/", "_").replace("\\", "_")
+        return f"{subfolder}_{item['filename']}" if subfolder else item["filename"]
+
+
+_HOST = socket.gethostname().replace(".", "-")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _CachingSink:
+    def __init__(self, key: str, entry_dir: str, inner):
+        self.key = key
+        self.entry_dir = entry_dir
+        self.inner = inner
+        self.download = True
+        self.chunk_size = inner.chunk_size
+
+    def open(self, node_id: str, item: dict):
+        path = os.path.join(self.entry_dir, ResultCache._file_name(item))
+        inner = self.inner.open(node_id, item) if self.inner.download else None
+        return _TeeWriter(path, inner, item)
+
+
+class _TeeWriter:
+    def __init__(self, path: str, inner, item: dict):
+        self.path = path
+        self.inner = inner
+        self.item = item
+        self.file = open(path + ".part", "wb")
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        if self.inner != None:
+            self.inner.write(chunk)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + ".part", self.path)
+        return self.inner.close() if self.inner != None else self.item
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.path + ".part")
+        except FileNotFoundError:
+            pass
+        if self.inner != None:
+            self.inner.abort()
@@ -3,11 +3,41 @@ import json
 
 # Web related
 import websocket
+import urllib.parse
 import urllib.request
 
+# Custom imports
+try:
+    from .pool import ConnectionPool
+    from .workflow import WorkflowJob, encode_prompt
+    from .uploads import (
+        UploadIndex,
+        upload_name,
+        local_images,
+        replace_images,
+        encode_multipart,
+    )
+except ImportError:
+    from pool import ConnectionPool
+    from workflow import WorkflowJob, encode_prompt
+    from uploads import (
+        UploadIndex,
+        upload_name,
+        local_images,
+        replace_images,
+        encode_multipart,
+    )
+
 
 class Client:
-    def __init__(self, server_address: str, client_id: str = None, log: bool = True):
+    def __init__(
+        self,
+        server_address: str,
+        client_id: str = None,
+        log: bool = True,
+        pool_size: int = 8,
+        upload_index: UploadIndex = None,
+    ):
         self.server_address = server_address
         if client_id == None:
             self.client_id = str(uuid.uuid4())
@@ -15,6 +45,9 @@ class Client:
             self.client_id = str(client_id)
         self.log = log
         self.connection = None
+        # Keep-alive HTTP connections shared by all REST calls, see `stats()`.
+        self.pool = ConnectionPool(server_address, max_size=pool_size)
+        self.upload_index = upload_index if upload_index != None else UploadIndex()
 
     def connect(self):
         if self.connection == None:
@@ -26,36 +59,115 @@ class Client:
                 print(f"Connected to client...")
 
     def queue_prompt(self, prompt):
-        p = {"prompt": prompt, "client_id": self.client_id}
-        data = json.dumps(p).encode("utf-8")
-        req = urllib.request.Request(f"http://{self.server_address}/prompt", data=data)
+        data = encode_prompt(prompt, self.client_id)
+        response = self.pool.request(
+            "POST", "/prompt", body=data, headers={"Content-Type": "application/json"}
+        )
         if self.log:
             print(f"Prompt queued")
-        return json.loads(urllib.request.urlopen(req).read())
+        return json.loads(response)
 
     def get_history(self, prompt_id):
-        with urllib.request.urlopen(
-            f"http://{self.server_address}/history/{prompt_id}"
-        ) as response:
-            return json.loads(response.read())
+        return json.loads(self.pool.request("GET", f"/history/{prompt_id}"))
 
     def get_image(self, filename, subfolder, folder_type):
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
         url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen(
-            f"http://{self.server_address}/view?{url_values}"
-        ) as response:
-            return response.read()
+        return self.pool.request("GET", f"/view?{url_values}")
+
+    def stream_image(self, filename, subfolder, folder_type, chunk_size: int = 1 << 20):
+        """
+        Same as `get_image` but yields the file in chunks of `chunk_size` bytes.
+        """
+        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        url_values = urllib.parse.urlencode(data)
+        with self.pool.open("GET", f"/view?{url_values}") as response:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def upload_image(self, image_path: str, subfolder: str = "") -> str:
+        """
+        Upload a local image to the server's input directory, unless an image with the
+        same content has already been uploaded there.
+
+        Returns
+        -------
+        str
+            Value to use for a LoadImage node's `image` input.
+        """
+        digest = self.upload_index.file_hash(image_path)
+        name = self.upload_index.get(self.server_address, digest)
+        if name != None:
+            return name
+        with open(image_path, "rb") as f:
+            content = f.read()
+        fields = {"type": "input", "subfolder": subfolder, "overwrite": "true"}
+        body, content_type = encode_multipart(
+            fields, upload_name(image_path, digest), content
+        )
+        response = json.loads(
+            self.pool.request(
+                "POST",
+                "/upload/image",
+                body=body,
+                headers={"Content-Type": content_type},
+            )
+        )
+        name = response["name"]
+        if response.get("subfolder"):
+            name = f"{response['subfolder']}/{name}"
+        self.upload_index.add(self.server_address, digest, name)
+        if self.log:
+            print(f"Uploaded {image_path} as {name}")
+        return name
+
+    def upload_inputs(self, workflow_data: dict | WorkflowJob):
+        """
+        Upload every local image referenced by a LoadImage node and return a workflow
+        that refers to the uploaded copies instead.
+        """
+        names = {
+            node_key: self.upload_image(path)
+            for node_key, path in local_images(workflow_data)
+        }
+        if not names:
+            return workflow_data
+        return replace_images(workflow_data, names)
+
+    def stats(self) -> dict:
+        """
+        Connection reuse rate and per-endpoint latency of the REST calls.
+        """
+        return self.pool.stats()
 
     def monitor(self, prompt_id: str):
+        self.wait_for_any([prompt_id])
+
+    def wait_for_any(self, prompt_ids) -> str:
+        """
+        Read the websocket until one of `prompt_ids` finishes executing.
+
+        Parameters
+        ----------
+        prompt_ids : Iterable[str]
+            Prompt ids that are currently queued on the server.
+
+        Returns
+        -------
+        str
+            The prompt id that completed.
+        """
         while True:
             out = self.connection.recv()
             if isinstance(out, str):
                 message = json.loads(out)
                 if message["type"] == "executing":
                     data = message["data"]
-                    if data["node"] is None and data["prompt_id"] == prompt_id:
-                        break  # Execution complete
+                    if data["node"] is None and data["prompt_id"] in prompt_ids:
+                        return data["prompt_id"]  # Execution complete
             else:
                 # Binary data (preview images)
                 continue
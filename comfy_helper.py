@@ -1,21 +1,118 @@
 import os
-import re
-import json
+from collections import deque
 
 # Custom imports
 try:
     from .client import Client
-    from .workflow import Workflow
-    from .utils.files import max_frame_number
+    from .workflow import Workflow, WorkflowJob
+    from .scheduler import Scheduler
+    from .outputs import MemorySink, OutputFetcher, collect_outputs
+    from .uploads import UploadIndex
+    from .journal import JobJournal
+    from .cache import ResultCache
+    from .utils.files import max_frame_number, frame_index, natural_sort_key
+    from .utils.image import resize_images
 except ImportError:
     from client import Client
-    from workflow import Workflow
-    from utils.files import max_frame_number
+    from workflow import Workflow, WorkflowJob
+    from scheduler import Scheduler
+    from outputs import MemorySink, OutputFetcher, collect_outputs
+    from uploads import UploadIndex
+    from journal import JobJournal
+    from cache import ResultCache
+    from utils.files import max_frame_number, frame_index, natural_sort_key
+    from utils.image import resize_images
 
 
 class ComfyHelper:
-    def __init__(self, server_address: str):
-        self.client = Client(server_address)
+    def __init__(
+        self,
+        server_address: str | list,
+        max_in_flight: int = 1,
+        output_sink=None,
+        fetch_workers: int = 1,
+        upload_images: bool = False,
+        upload_index_path: str = None,
+        journal_path: str = None,
+        cache_dir: str = None,
+        cache_max_bytes: int = 10 * 1024**3,
+        prescale: dict = None,
+        prescale_dir: str = "prescaled",
+    ):
+        """
+        Parameters
+        ----------
+        server_address : str | list
+            Address of the ComfyUI server, e.g. "127.0.0.1:8188". Passing a list of
+            addresses spreads the batch jobs across all of them through a `Scheduler`.
+        max_in_flight : int, optional
+            Number of prompts kept queued on each server at once. A value of 1 waits
+            for every prompt before queuing the next one, by default 1
+        output_sink : MemorySink | FileSink | GeneratorSink | NullSink, optional
+            Where the output files of every prompt go, see `outputs`. Use `NullSink`
+            to skip downloads or `FileSink` to stream them to disk, by default MemorySink
+        fetch_workers : int, optional
+            Number of output files downloaded concurrently. Above 1 the downloads run
+            in the background while the next prompts are queued, by default 1
+        upload_images : bool, optional
+            Upload source images through the server's /upload/image endpoint instead
+            of passing local paths, for servers on another machine. Each image is
+            uploaded once per server, by default False
+        upload_index_path : str, optional
+            File that remembers uploaded images between runs, by default None
+        journal_path : str, optional
+            Job journal used to resume interrupted batches. Jobs recorded as completed
+            are skipped instead of resuming from the highest frame number in
+            `reference_dir`, by default None
+        cache_dir : str, optional
+            Directory of a `ResultCache`. Jobs whose fully edited workflow and input
+            images match a cached run are served from the cache instead of being
+            queued. Only jobs with a fixed `seed` can match, by default None
+        cache_max_bytes : int, optional
+            Cache size above which least recently used results are evicted, by default 10 GiB
+        prescale : dict, optional
+            Resize source images before the IMG2IMG methods queue them, e.g.
+            {"width_preference": 1024, "height_preference": 1024}. Keyword arguments
+            of `utils.image.resize_images`, by default None (no resizing)
+        prescale_dir : str, optional
+            Where the resized copies are kept between runs, by default "prescaled"
+        """
+        self.max_in_flight = max_in_flight
+        self.output_sink = output_sink if output_sink != None else MemorySink()
+        self.upload_images = upload_images
+        self.prescale = prescale
+        self.prescale_dir = prescale_dir
+        upload_index = UploadIndex(upload_index_path) if upload_images else None
+        self.journal = JobJournal(journal_path) if journal_path != None else None
+        self.cache = None
+        if cache_dir != None:
+            self.cache = ResultCache(cache_dir, max_bytes=cache_max_bytes)
+        # prompt_id -> caching sink of a job whose outputs are not committed yet
+        self._cache_sinks = {}
+        if isinstance(server_address, list):
+            self.client = None
+            self.scheduler = Scheduler(
+                server_address,
+                max_in_flight=max_in_flight,
+                output_sink=self.output_sink,
+                upload_index=upload_index,
+                journal=self.journal,
+                cache=self.cache,
+            )
+        else:
+            # Every download holds a connection for its whole stream, so keep one
+            # free for queue_prompt/get_history while the fetcher is busy.
+            self.client = Client(
+                server_address,
+                pool_size=max(8, fetch_workers + 1),
+                upload_index=upload_index,
+            )
+            self.scheduler = None
+        self.fetcher = None
+        if self.client != None and fetch_workers > 1:
+            self.fetcher = OutputFetcher(
+                self.output_sink, self._stream_output, workers=fetch_workers
+            )
 
     def multi_image_single_prompt_IMG2IMG(
         self,
@@ -27,6 +124,7 @@ class ComfyHelper:
         reference_prefix: str = "",
         override_index: int = -1,
         file_paths: list = [],
+        seed: int = -1,
     ):
         """
         Use multiple images and a single prompt to generate further images.
@@ -43,44 +141,54 @@ class ComfyHelper:
             Prefix to use for the file when it is saved.
         file_paths : list, optional
             Optionally provide a list of files to override the automatic search, by default []
+        seed : int, optional
+            Sampler seed for every job, -1 picks a random seed per job, by default -1
         """
-        self.client.connect()
+        self._connect()
         workflow = Workflow(workflow_path)
         base_file = os.listdir(source_dir)
-        base_file = sorted(base_file, key=lambda s: int(re.search(r"\d+", s).group()))
-        if reference_dir != "" and override_index == -1:
+        base_file = sorted(base_file, key=natural_sort_key)
+        if reference_dir != "" and override_index == -1 and self.journal == None:
             max_frame = max_frame_number(reference_dir, reference_prefix)
             base_file = base_file[max_frame - 1 :]
             # base_file = self._get_missing_frames(source_dir, reference_dir)
 
         if override_index != -1:
             base_file = base_file[override_index:]
-        try:
+        image_paths = self._prescale(
+            file_paths or [os.path.join(source_dir, i) for i in base_file]
+        )
+
+        def jobs():
             if file_paths != []:
-                for i in file_paths:
-                    workflow_data = workflow.edit_workflow(
+                for i in image_paths:
+                    workflow_data = workflow.create_job(
                         pos_prompt=prompt,
                         neg_prompt="",
                         image_path=i,
                         prefix=output_prefix,
+                        seed=seed,
                     )
                     print(f"Executing prompt: {prompt}   Image: {i}")
                     print(workflow_data)
-                    self.execute_IMG2IMG(workflow_data)
+                    yield workflow_data
             else:
-                for i in base_file:
-                    image_path = os.path.join(source_dir, i)
-                    workflow_data = workflow.edit_workflow(
+                for i, image_path in zip(base_file, image_paths):
+                    workflow_data = workflow.create_job(
                         pos_prompt=prompt,
                         neg_prompt="",
                         image_path=image_path,
                         prefix=output_prefix,
+                        seed=seed,
                     )
                     print(f"Executing prompt: {prompt}   Image: {i}")
-                    self.execute_IMG2IMG(workflow_data)
+                    yield workflow_data
+
+        try:
+            self._run_jobs(jobs())
         except KeyboardInterrupt:
             pass
-        self.client.connection.close()
+        self._close()
         print(f"Client Closed")
 
     def singe_image_multi_prompt_IMG2IMG(
@@ -89,17 +197,25 @@ class ComfyHelper:
         prompts: list,
         image_path: str,
         output_prefix: str,
+        seed: int = -1,
     ):
-        self.client.connect()
+        self._connect()
         workflow = Workflow(workflow_path)
-        try:
+        image_path = self._prescale([image_path])[0]
+
+        def jobs():
             for p in prompts:
-                workflow_data = workflow.edit_workflow(p, "", image_path, output_prefix)
+                workflow_data = workflow.create_job(
+                    p, "", image_path, output_prefix, seed=seed
+                )
                 print(f"Executing prompt: {p}")
-                self.execute_IMG2IMG(workflow_data)
+                yield workflow_data
+
+        try:
+            self._run_jobs(jobs())
         except KeyboardInterrupt:
             pass
-        self.client.connection.close()
+        self._close()
 
     def multi_image_multi_prompt_IMG2IMG(
         self,
@@ -107,23 +223,41 @@ class ComfyHelper:
         images_or_dir: str | list,
         prompts: list,
         output_prefix: str,
+        seed: int = -1,
+        paired: bool = False,
     ):
-        self.client.connect()
+        """
+        Run every prompt on every image, or with `paired` the i-th prompt on the i-th
+        image only, e.g. with the captions from `utils.llm.img2text.caption_images`.
+        """
         workflow = Workflow(workflow_path)
         if isinstance(images_or_dir, str):
-            images = os.listdir(images_or_dir)
+            images = sorted(os.listdir(images_or_dir), key=natural_sort_key)
             images_or_dir = [os.path.join(images_or_dir, image) for image in images]
-        try:
-            for i in images_or_dir:
-                for p in prompts:
-                    workflow_data = workflow.edit_workflow(
-                        pos_prompt=p, neg_prompt="", image_path=i, prefix=output_prefix
+        images_or_dir = self._prescale(images_or_dir)
+
+        if paired and len(prompts) != len(images_or_dir):
+            raise ValueError("paired needs exactly one prompt per image")
+        self._connect()
+
+        def jobs():
+            for n, i in enumerate(images_or_dir):
+                for p in [prompts[n]] if paired else prompts:
+                    workflow_data = workflow.create_job(
+                        pos_prompt=p,
+                        neg_prompt="",
+                        image_path=i,
+                        prefix=output_prefix,
+                        seed=seed,
                     )
                     print(f"Executing prompt: {p}")
-                    self.execute_IMG2IMG(workflow_data)
+                    yield workflow_data
+
+        try:
+            self._run_jobs(jobs())
         except KeyboardInterrupt:
             pass
-        self.client.connection.close()
+        self._close()
 
     """
     ===================================================================================
@@ -131,42 +265,165 @@ class ComfyHelper:
     ===================================================================================
     """
 
-    def _execute_workflow(self, workflow_data: dict):
-        prompt_id = self.client.queue_prompt(workflow_data)["prompt_id"]
-        print(f"PROMPT ID: {prompt_id}")
-        while True:
-            out = self.client.connection.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message["type"] == "executing":
-                    data = message["data"]
-                    if data["node"] is None and data["prompt_id"] == prompt_id:
-                        break  # Execution complete
-            else:
-                # Binary data (preview images)
+    def close(self):
+        """
+        Stop the background download threads and close the job journal. Call once
+        the helper is no longer needed, or use it as a context manager.
+        """
+        if self.fetcher != None:
+            self.fetcher.close()
+            self.fetcher = None
+        if self.journal != None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _connect(self):
+        # The scheduler opens its own connections for every server.
+        if self.client != None:
+            self.client.connect()
+
+    def _close(self):
+        if self.client != None:
+            self.client.connection.close()
+            self.client.connection = None
+        if self.journal != None:
+            self.journal.flush()
+
+    def _prescale(self, paths: list) -> list:
+        """
+        Swap source images for copies resized per `self.prescale`, resizing only what
+        changed since the last run. Images that cannot be read are left as they are.
+        """
+        if self.prescale == None:
+            return paths
+        resized = resize_images(paths, self.prescale_dir, **self.prescale)
+        return [resized.get(p, p) for p in paths]
+
+    def _run_jobs(self, jobs):
+        """
+        Execute every workflow produced by `jobs`, either one at a time, pipelined
+        depending on `max_in_flight`, or across several servers.
+        """
+        if self.journal != None:
+            jobs = self.journal.incomplete(jobs)
+        if self.cache != None:
+            jobs = self.cache.misses_only(jobs, self.output_sink)
+        if self.scheduler != None:
+            self.scheduler.run(jobs)
+            return
+        if self.max_in_flight <= 1:
+            for workflow_data in jobs:
+                self.execute_IMG2IMG(workflow_data)
+        else:
+            self._execute_pipelined(jobs)
+
+    def _execute_workflow(self, workflow_data: dict | WorkflowJob) -> dict:
+        prompt_id = self._queue(workflow_data)
+        self.client.monitor(prompt_id)
+        history, outputs = self._collect_outputs(workflow_data, prompt_id)
+        return self._finish(workflow_data, prompt_id, history, outputs)
+
+    def _execute_pipelined(self, jobs):
+        """
+        Keep up to `max_in_flight` prompts queued on the server. A single websocket
+        reader matches completions back to their prompt ids, and the queue is topped
+        up before the outputs of a finished prompt are fetched so the server never
+        sits idle between jobs.
+        """
+        jobs = iter(jobs)
+        in_flight = {}
+        downloads = deque()
+
+        def fill():
+            while len(in_flight) < self.max_in_flight:
+                workflow_data = next(jobs, None)
+                if workflow_data is None:
+                    return
+                in_flight[self._queue(workflow_data)] = workflow_data
+
+        fill()
+        while in_flight:
+            prompt_id = self.client.wait_for_any(in_flight)
+            workflow_data = in_flight.pop(prompt_id)
+            # Refill the server queue before spending time on downloads.
+            fill()
+            history, outputs = self._collect_outputs(workflow_data, prompt_id)
+            if self.fetcher == None:
+                self._finish(workflow_data, prompt_id, history, outputs)
                 continue
+            # Downloads overlap with the next prompts, only wait once too many
+            # prompts' outputs are outstanding.
+            downloads.append((workflow_data, prompt_id, history, outputs))
+            while downloads and (
+                downloads[0][3].done() or len(downloads) > self.max_in_flight
+            ):
+                self._finish(*downloads.popleft())
+        while downloads:
+            self._finish(*downloads.popleft())
 
+    def _queue(self, workflow_data: dict | WorkflowJob) -> str:
+        prompt = workflow_data
+        if self.upload_images:
+            prompt = self.client.upload_inputs(prompt)
+        prompt_id = self.client.queue_prompt(prompt)["prompt_id"]
+        print(f"PROMPT ID: {prompt_id}")
+        if self.journal != None:
+            self.journal.record_submitted(
+                workflow_data, prompt_id, self.client.server_address
+            )
+        return prompt_id
+
+    def _collect_outputs(self, workflow_data: dict | WorkflowJob, prompt_id: str):
         # Get history for the executed prompt
         history = self.client.get_history(prompt_id)[prompt_id]
-        # Since a ComfyUI workflow may contain multiple SaveImage nodes,
-        # and each SaveImage node might save multiple images,
-        # we need to iterate through all outputs to collect all generated images
-        output_images = {}
-        for node_id in history["outputs"]:
-            node_output = history["outputs"][node_id]
-            images_output = []
-            if "images" in node_output:
-                for image in node_output["images"]:
-                    image_data = self.client.get_image(
-                        image["filename"], image["subfolder"], image["type"]
-                    )
-                    images_output.append(image_data)
-            output_images[node_id] = images_output
+        # A workflow may contain several SaveImage/VHS_VideoCombine nodes, each
+        # saving several files, so every output is handed to the sink.
+        sink = self.output_sink
+        if self.cache != None:
+            sink = self.cache.sink(sink, workflow_data)
+            self._cache_sinks[prompt_id] = sink
+        if self.fetcher != None:
+            return history, self.fetcher.submit(history, sink)
+        try:
+            return history, collect_outputs(history, sink, self._stream_output)
+        except BaseException:
+            if self.cache != None:
+                self.cache.discard(self._cache_sinks.pop(prompt_id))
+            raise
+
+    def _finish(self, workflow_data, prompt_id: str, history: dict, outputs) -> dict:
+        cache_sink = self._cache_sinks.pop(prompt_id, None)
+        # Wait for background downloads before the job counts as complete.
+        if self.fetcher != None:
+            try:
+                outputs = outputs.result()
+            except BaseException:
+                if cache_sink != None:
+                    self.cache.discard(cache_sink)
+                raise
+        if cache_sink != None:
+            self.cache.commit(cache_sink, history)
+        if self.journal != None:
+            self.journal.record_completed(workflow_data, prompt_id, history)
+        return outputs
+
+    def _stream_output(self, item: dict, chunk_size: int):
+        return self.client.stream_image(
+            item["filename"], item["subfolder"], item["type"], chunk_size
+        )
 
-    def execute_IMG2IMG(self, workflow_data: dict):
-        self._execute_workflow(workflow_data)
+    def execute_IMG2IMG(self, workflow_data: dict | WorkflowJob) -> dict:
+        if self.scheduler != None:
+            return self.scheduler.run([workflow_data])[0]
+        return self._execute_workflow(workflow_data)
 
     def _get_missing_frames(self, source_dir: str, target_dir: str):
-        result = [x for x in os.listdir(source_dir) if x not in os.listdir(target_dir)]
-        result = sorted(result, key=lambda x: int(re.search(r"\d+", x).group()))
+        source = frame_index(source_dir, exts=None)
+        result = source.missing_from(frame_index(target_dir, exts=None))
+        result = sorted(result, key=natural_sort_key)
         return result
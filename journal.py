@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import deque
+
+# Custom imports
+try:
+    from .workflow import WorkflowJob, encode_prompt
+    from .outputs import output_items
+except ImportError:
+    from workflow import WorkflowJob, encode_prompt
+    from outputs import output_items
+
+
+def job_key(job, occurrence: int = 0) -> str:
+    """
+    Stable identity of a job. `WorkflowJob`s are keyed by the absolute path and content
+    of their workflow and the inputs they were created from, with the input image's
+    path made absolute, so a job keeps its key across restarts and working
+    directories even though its random seed changes. Plain dicts are keyed by their
+    full graph.
+
+    `occurrence` tells identical jobs of one batch apart, e.g. the same prompt queued
+    five times with random seeds is five jobs, not one.
+    """
+    if isinstance(job, WorkflowJob) and job.inputs != None:
+        inputs = dict(job.inputs)
+        if inputs.get("image_path"):
+            inputs["image_path"] = os.path.abspath(inputs["image_path"])
+        payload = json.dumps(
+            {
+                "workflow": os.path.abspath(job.workflow.path),
+                "digest": job.workflow.digest,
+                "inputs": inputs,
+                "occurrence": occurrence,
+            },
+            sort_keys=True,
+        ).encode("utf-8")
+    else:
+        payload = encode_prompt(job, "") + b"#%d" % occurrence
+    return hashlib.sha256(payload).hexdigest()
+
+
+class JobJournal:
+    """
+    Append-only JSON lines log of submitted and completed jobs.
+
+    Every record carries the job key (see `job_key`), so restarting a batch only has to
+    replay the journal to know which jobs are done, without listing any directory.
+    Repeats of the same job are numbered in the order `incomplete` sees them, so the
+    batch must be regenerated in the same order to resume.
+    Records are flushed in batches and fsync'd every `sync_every` records or
+    `sync_interval` seconds; a crash loses at most that batch, and those jobs are simply
+    run again.
+    """
+
+    def __init__(self, path: str, sync_every: int = 32, sync_interval: float = 1.0):
+        """
+        Parameters
+        ----------
+        path : str
+            Journal file, created if it does not exist.
+        sync_every : int, optional
+            Records written between fsyncs, by default 32
+        sync_interval : float, optional
+            Maximum seconds between fsyncs, by default 1.0
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.submitted = {}
+        self.completed = {}
+        self._lock = threading.Lock()
+        self._pending = 0
+        # job_key(job) -> repeats of that job seen by `incomplete`
+        self._occurrences = {}
+        # job_key(job) -> keys of the repeats yielded by `incomplete`, not yet submitted
+        self._unsubmitted = {}
+        # id(job) -> (job, key) while a job is in flight, so retries keep their key
+        self._in_flight = {}
+        # prompt_id -> key
+        self._prompt_keys = {}
+        self._last_sync = time.monotonic()
+        self._replay()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from a crash mid-write.
+                    continue
+                if record["event"] == "submitted":
+                    self.submitted[record["key"]] = record
+                elif record["event"] == "completed":
+                    self.completed[record["key"]] = record
+
+    def is_complete(self, job) -> bool:
+        return job_key(job) in self.completed
+
+    def incomplete(self, jobs):
+        """
+        Yield only the jobs that have not completed yet.
+        """
+        for job in jobs:
+            base = job_key(job)
+            occurrence = self._occurrences.get(base, 0)
+            self._occurrences[base] = occurrence + 1
+            key = base if occurrence == 0 else job_key(job, occurrence)
+            if key in self.completed:
+                print(f"Skipping completed job: {job}")
+                continue
+            self._unsubmitted.setdefault(base, deque()).append(key)
+            yield job
+
+    def _key_for(self, job) -> str:
+        in_flight = self._in_flight.get(id(job))
+        if in_flight != None and in_flight[0] is job:
+            return in_flight[1]
+        base = job_key(job)
+        unsubmitted = self._unsubmitted.get(base)
+        key = unsubmitted.popleft() if unsubmitted else base
+        self._in_flight[id(job)] = (job, key)
+        return key
+
+    def record_submitted(self, job, prompt_id: str, server: str):
+        inputs = job.inputs if isinstance(job, WorkflowJob) else None
+        key = self._key_for(job)
+        self._prompt_keys[prompt_id] = key
+        self._write(
+            {
+                "event": "submitted",
+                "key": key,
+                "inputs": inputs,
+                "prompt_id": prompt_id,
+                "server": server,
+            }
+        )
+
+    def record_completed(self, job, prompt_id: str, history: dict):
+        key = self._prompt_keys.pop(prompt_id, None)
+        if key == None:
+            key = self._key_for(job)
+        self._in_flight.pop(id(job), None)
+        outputs = {
+            node_id: output_items(node_output)
+            for node_id, node_output in history["outputs"].items()
+        }
+        self._write(
+            {
+                "event": "completed",
+                "key": key,
+                "prompt_id": prompt_id,
+                "outputs": outputs,
+            }
+        )
+
+    def _write(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            if record["event"] == "submitted":
+                self.submitted[record["key"]] = record
+            else:
+                self.completed[record["key"]] = record
+            self._pending += 1
+            now = time.monotonic()
+            if (
+                self._pending >= self.sync_every
+                or now - self._last_sync >= self.sync_interval
+            ):
+                self._sync(now)
+
+    def _sync(self, now: float):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = now
+
+    def flush(self):
+        with self._lock:
+            self._sync(time.monotonic())
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync(time.monotonic())
+                self._file.close()
@@ -0,0 +1,325 @@
+import io
+import os
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# History keys that hold downloadable files. VHS_VideoCombine reports its
+# videos/gifs under "gifs".
+OUTPUT_KEYS = ("images", "gifs", "videos")
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+def output_items(node_output: dict) -> list:
+    """
+    Return the file entries ({"filename", "subfolder", "type"}) of one history output.
+    """
+    items = []
+    for key in OUTPUT_KEYS:
+        for item in node_output.get(key, []):
+            if isinstance(item, dict) and "filename" in item:
+                items.append(item)
+    return items
+
+
+def collect_outputs(history: dict, sink, stream) -> dict:
+    """
+    Send every output file of a finished prompt to `sink`.
+
+    Parameters
+    ----------
+    history : dict
+        History entry of the prompt, as returned by `Client.get_history(prompt_id)[prompt_id]`.
+    sink : MemorySink | FileSink | GeneratorSink | NullSink
+        Where the files go.
+    stream : Callable[[dict, int], Iterable[bytes]]
+        Returns the chunks of an output file given its entry and the chunk size.
+
+    Returns
+    -------
+    dict
+        Node id -> list of sink results, in the order the server reported them.
+    """
+    outputs = {}
+    with contextlib.closing(output_downloads(history, sink, outputs)) as downloads:
+        for item, writer in downloads:
+            for chunk in stream(item, sink.chunk_size):
+                writer.write(chunk)
+    return outputs
+
+
+def output_downloads(history: dict, sink, outputs: dict):
+    """
+    Yield `(item, writer)` for every output file of `history` that `sink` wants; the
+    caller writes the file's chunks to `writer` before asking for the next one. Sink
+    results (or the file entries, when the sink does not download) are collected in
+    `outputs` as node id -> list, like `collect_outputs` returns them.
+
+    Closing the generator early, or an exception while it is suspended, aborts the
+    file being written so no partial output is left behind. Wrap it in
+    `contextlib.closing` to make that happen as soon as the caller fails.
+    """
+    for node_id, node_output in history["outputs"].items():
+        results = outputs.setdefault(node_id, [])
+        for item in output_items(node_output):
+            if not sink.download:
+                results.append(item)
+                continue
+            writer = sink.open(node_id, item)
+            try:
+                yield item, writer
+                results.append(writer.close())
+            except BaseException:
+                writer.abort()
+                raise
+
+
+class OutputFetcher:
+    """
+    Download the outputs of finished prompts on a pool of worker threads.
+
+    `submit` returns immediately, so the caller can queue the next prompt while the
+    files of the previous one are still downloading. Call `result()` on the returned
+    object to get the same dict `collect_outputs` builds, in node order.
+    """
+
+    def __init__(self, sink, stream, workers: int = 4):
+        """
+        Parameters
+        ----------
+        sink : MemorySink | FileSink | GeneratorSink | NullSink
+            Where the files go. Writers are only ever used by one thread at a time.
+        stream : Callable[[dict, int], Iterable[bytes]]
+            Returns the chunks of an output file given its entry and the chunk size.
+            Must be safe to call from several threads, e.g. `Client.stream_image`.
+        workers : int, optional
+            Number of concurrent downloads, by default 4
+        """
+        self.sink = sink
+        self.stream = stream
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        # (start, end) of every finished download
+        self._intervals = []
+
+    def submit(self, history: dict, sink=None) -> "PendingOutputs":
+        """
+        Start downloading the outputs of `history`, into `sink` if given instead of
+        the fetcher's own sink.
+        """
+        sink = sink if sink != None else self.sink
+        node_futures = []
+        for node_id, node_output in history["outputs"].items():
+            futures = [
+                self.executor.submit(self._fetch, sink, node_id, item)
+                for item in output_items(node_output)
+            ]
+            node_futures.append((node_id, futures))
+        return PendingOutputs(node_futures)
+
+    def _fetch(self, sink, node_id: str, item: dict):
+        if not sink.download:
+            return item
+        start = time.perf_counter()
+        size = 0
+        writer = sink.open(node_id, item)
+        try:
+            for chunk in self.stream(item, sink.chunk_size):
+                writer.write(chunk)
+                size += len(chunk)
+            result = writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        end = time.perf_counter()
+        with self._lock:
+            self._bytes += size
+            self._intervals.append((start, end))
+        return result
+
+    def stats(self) -> dict:
+        """
+        Returns
+        -------
+        dict
+            Files and bytes downloaded, throughput in bytes/sec over the time any
+            download was running, and mean/p95/max per-file latency in milliseconds.
+        """
+        with self._lock:
+            intervals = sorted(self._intervals)
+            total = self._bytes
+        if not intervals:
+            return {"files": 0, "bytes": 0, "bytes_per_sec": 0.0}
+        latencies = sorted(end - start for start, end in intervals)
+        # Union of the download intervals, gaps with nothing downloading don't count.
+        elapsed = 0.0
+        busy_start, busy_end = intervals[0]
+        for start, end in intervals[1:]:
+            if start > busy_end:
+                elapsed += busy_end - busy_start
+                busy_start = start
+            busy_end = max(busy_end, end)
+        elapsed += busy_end - busy_start
+        return {
+            "files": len(latencies),
+            "bytes": total,
+            "bytes_per_sec": total / elapsed if elapsed else 0.0,
+            "mean_ms": 1000 * sum(latencies) / len(latencies),
+            "p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+            "max_ms": 1000 * latencies[-1],
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class PendingOutputs:
+    """
+    Outputs of one prompt that are still downloading.
+    """
+
+    def __init__(self, node_futures: list):
+        self.node_futures = node_futures
+
+    def done(self) -> bool:
+        return all(f.done() for _, futures in self.node_futures for f in futures)
+
+    def result(self) -> dict:
+        return {
+            node_id: [f.result() for f in futures]
+            for node_id, futures in self.node_futures
+        }
+
+
+"""
+===================================================================================
+Sinks
+===================================================================================
+"""
+
+
+class NullSink:
+    """
+    Skip downloads entirely, the results are the server-side file entries.
+    """
+
+    download = False
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    def open(self, node_id: str, item: dict):
+        raise RuntimeError("NullSink does not download outputs")
+
+
+class MemorySink:
+    """
+    Keep each output in memory, the results are the raw bytes.
+    """
+
+    download = True
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    def open(self, node_id: str, item: dict):
+        return _MemoryWriter()
+
+
+class FileSink:
+    """
+    Stream each output to `output_dir` one chunk at a time, the results are the local
+    paths. The server's subfolder is kept, and a file only appears under its final name
+    once it has been fully written.
+    """
+
+    download = True
+
+    def __init__(self, output_dir: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+
+    def open(self, node_id: str, item: dict):
+        directory = os.path.join(self.output_dir, item.get("subfolder", ""))
+        os.makedirs(directory, exist_ok=True)
+        return _FileWriter(os.path.join(directory, item["filename"]))
+
+
+class GeneratorSink:
+    """
+    Hand each output to a caller-supplied generator.
+
+    `consumer(node_id, item)` must return a generator that receives the chunks through
+    `send()` followed by a final `None`; whatever it returns becomes the result. If the
+    download fails, the generator is closed instead.
+
+        def consumer(node_id, item):
+            size = 0
+            while (chunk := (yield)) is not None:
+                size += len(chunk)
+            return size
+    """
+
+    download = True
+
+    def __init__(self, consumer, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.consumer = consumer
+        self.chunk_size = chunk_size
+
+    def open(self, node_id: str, item: dict):
+        return _GeneratorWriter(self.consumer(node_id, item))
+
+
+class _MemoryWriter:
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, chunk: bytes):
+        self.buffer.write(chunk)
+
+    def close(self) -> bytes:
+        return self.buffer.getvalue()
+
+    def abort(self):
+        self.buffer.close()
+
+
+class _FileWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path + ".part", "wb")
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def close(self) -> str:
+        self.file.close()
+        os.replace(self.path + ".part", self.path)
+        return self.path
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.path + ".part")
+        except FileNotFoundError:
+            pass
+
+
+class _GeneratorWriter:
+    def __init__(self, generator):
+        self.generator = generator
+        next(self.generator)
+
+    def write(self, chunk: bytes):
+        self.generator.send(chunk)
+
+    def close(self):
+        try:
+            self.generator.send(None)
+        except StopIteration as e:
+            return e.value
+        raise RuntimeError("Output consumer did not stop after the final None")
+
+    def abort(self):
+        self.generator.close()
@@ -0,0 +1,150 @@
+import io
+import time
+import queue
+import threading
+import http.client
+import urllib.error
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """
+    Bounded pool of persistent HTTP/1.1 connections to a single server.
+
+    Connections are handed out to one request at a time and returned afterwards, so
+    they can be shared between threads. The pool also counts how often a connection
+    was reused and how long each endpoint takes to answer.
+    """
+
+    # Errors raised when the server has silently dropped an idle keep-alive socket.
+    _STALE_ERRORS = (
+        http.client.RemoteDisconnected,
+        http.client.CannotSendRequest,
+        BrokenPipeError,
+        ConnectionResetError,
+    )
+
+    def __init__(self, server_address: str, max_size: int = 8, timeout: float = 60):
+        """
+        Parameters
+        ----------
+        server_address : str
+            "host:port" of the server.
+        max_size : int, optional
+            Maximum number of open connections, by default 8
+        timeout : float, optional
+            Socket timeout in seconds, by default 60
+        """
+        self.server_address = server_address
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self._latency = {}
+
+    def request(self, method: str, path: str, body: bytes = None, headers=None):
+        """
+        Send a request and return the full response body.
+        """
+        with self.open(method, path, body=body, headers=headers) as response:
+            return response.read()
+
+    @contextmanager
+    def open(self, method: str, path: str, body: bytes = None, headers=None):
+        """
+        Send a request and yield the response so the body can be read incrementally.
+        The connection goes back to the pool once the block exits.
+
+        Raises
+        ------
+        urllib.error.HTTPError
+            If the server answers with a 4xx or 5xx status, matching `urlopen`.
+        """
+        headers = headers or {}
+        self._slots.acquire()
+        connection = None
+        start = time.perf_counter()
+        try:
+            connection, response, reused = self._send(method, path, body, headers)
+            if response.status >= 400:
+                raise urllib.error.HTTPError(
+                    f"http://{self.server_address}{path}",
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    io.BytesIO(response.read()),
+                )
+            yield response
+            # Drain anything the caller left unread so the socket can be reused.
+            response.read()
+            if response.will_close:
+                connection.close()
+            else:
+                self._idle.put(connection)
+            connection = None
+            self._record(path, start, reused)
+        finally:
+            if connection != None:
+                connection.close()
+            self._slots.release()
+
+    def _send(self, method: str, path: str, body: bytes, headers: dict):
+        try:
+            connection = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self._new_connection()
+            reused = False
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            return connection, connection.getresponse(), reused
+        except self._STALE_ERRORS:
+            connection.close()
+            if not reused:
+                raise
+        # The idle connection had been closed by the server, retry on a fresh one.
+        connection = self._new_connection()
+        connection.request(method, path, body=body, headers=headers)
+        return connection, connection.getresponse(), False
+
+    def _new_connection(self):
+        return http.client.HTTPConnection(self.server_address, timeout=self.timeout)
+
+    def _record(self, path: str, start: float, reused: bool):
+        elapsed = time.perf_counter() - start
+        endpoint = "/" + path.lstrip("/").split("?")[0].split("/")[0]
+        with self._lock:
+            self.requests += 1
+            if reused:
+                self.reused += 1
+            count, total = self._latency.get(endpoint, (0, 0.0))
+            self._latency[endpoint] = (count + 1, total + elapsed)
+
+    def stats(self) -> dict:
+        """
+        Returns
+        -------
+        dict
+            Request count, reuse count and rate, and the request count and mean
+            latency in milliseconds for every endpoint.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "reused": self.reused,
+                "reuse_rate": self.reused / self.requests if self.requests else 0.0,
+                "endpoints": {
+                    endpoint: {"count": count, "mean_ms": 1000 * total / count}
+                    for endpoint, (count, total) in self._latency.items()
+                },
+            }
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
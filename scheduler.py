@@ -0,0 +1,197 @@
+import copy
+import asyncio
+import contextlib
+from collections import deque
+
+# Custom imports
+try:
+    from .async_client import AsyncClient
+    from .outputs import MemorySink, output_downloads
+    from .uploads import UploadIndex
+    from .journal import JobJournal
+    from .cache import ResultCache
+    from .utils.lazy import lazy_import
+except ImportError:
+    from async_client import AsyncClient
+    from outputs import MemorySink, output_downloads
+    from uploads import UploadIndex
+    from journal import JobJournal
+    from cache import ResultCache
+    from utils.lazy import lazy_import
+
+# Web related, imported on first use
+aiohttp = lazy_import("aiohttp")
+
+
+class Scheduler:
+    """
+    Spread workflow jobs across several ComfyUI servers.
+
+    Each server gets its own `AsyncClient`, all driven from one event loop. New jobs go
+    to the least-loaded server, judged by the queue depth the server reports through
+    websocket `status` messages, and jobs running on a server that disconnects are put
+    back in the queue for the remaining servers.
+    """
+
+    def __init__(
+        self,
+        server_addresses: list,
+        max_in_flight: int = 2,
+        output_sink=None,
+        upload_index: UploadIndex = None,
+        journal: JobJournal = None,
+        cache: ResultCache = None,
+        log: bool = True,
+    ):
+        """
+        Parameters
+        ----------
+        server_addresses : list
+            Addresses of the ComfyUI servers, e.g. ["10.0.0.2:8188", "10.0.0.3:8188"].
+        max_in_flight : int, optional
+            Number of prompts kept queued on each server, by default 2
+        output_sink : MemorySink | FileSink | GeneratorSink | NullSink, optional
+            Where the output files of every prompt go, by default MemorySink
+        upload_index : UploadIndex, optional
+            When given, local images in LoadImage nodes are uploaded to whichever
+            server runs the job, once per server, by default None
+        journal : JobJournal, optional
+            Records which server each job went to and when it completed, by default None
+        cache : ResultCache, optional
+            Stores the outputs of every finished job, by default None
+        log : bool, optional
+            Print dispatch and failover messages, by default True
+        """
+        self.clients = [
+            AsyncClient(a, log=False, upload_index=upload_index)
+            for a in server_addresses
+        ]
+        self.upload_images = upload_index != None
+        self.journal = journal
+        self.cache = cache
+        self.max_in_flight = max_in_flight
+        self.output_sink = output_sink if output_sink != None else MemorySink()
+        self.log = log
+
+    def run(self, jobs):
+        """
+        Execute every workflow produced by `jobs` and block until all are done.
+        Returns the outputs of every job (see `collect_outputs`) in the order the
+        jobs finished.
+        """
+        return asyncio.run(self.run_async(jobs))
+
+    async def run_async(self, jobs):
+        jobs = iter(jobs)
+        retry = deque()
+        in_flight = {}
+        finished = []
+        load = {client: 0 for client in self.clients}
+        results = await asyncio.gather(
+            *(client.connect() for client in self.clients), return_exceptions=True
+        )
+        for client, result in zip(self.clients, results):
+            if isinstance(result, BaseException) and self.log:
+                print(f"{client.server_address} failed to connect ({result})")
+        try:
+            while True:
+                while True:
+                    client = self._least_loaded(load)
+                    if client is None:
+                        break
+                    if retry:
+                        workflow_data = retry.popleft()
+                    else:
+                        workflow_data = next(jobs, None)
+                        if workflow_data is None:
+                            break
+                        # Raw graphs may be edited in place by the caller, keep a
+                        # private copy so the job can be resent after a failure.
+                        # WorkflowJob instances never change once created.
+                        if isinstance(workflow_data, dict):
+                            workflow_data = copy.deepcopy(workflow_data)
+                    task = asyncio.create_task(self._execute(client, workflow_data))
+                    in_flight[task] = (client, workflow_data)
+                    load[client] += 1
+
+                if not in_flight:
+                    # Nothing is running, so either every job is done or no server
+                    # is left to run the remaining ones.
+                    if retry or next(jobs, None) is not None:
+                        raise ConnectionError("No ComfyUI servers are reachable")
+                    return finished
+
+                done, _ = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    client, workflow_data = in_flight.pop(task)
+                    load[client] -= 1
+                    try:
+                        finished.append(task.result())
+                    except aiohttp.ClientResponseError:
+                        # The server rejected the request, sending it again or to
+                        # another server would not help.
+                        raise
+                    except (ConnectionError, aiohttp.ClientError) as e:
+                        if self.log:
+                            print(
+                                f"{client.server_address} failed ({e}), requeuing job"
+                            )
+                        retry.append(workflow_data)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(
+                *(client.close() for client in self.clients), return_exceptions=True
+            )
+
+    def _least_loaded(self, load: dict):
+        candidates = [
+            client
+            for client in self.clients
+            if client.connection != None and load[client] < self.max_in_flight
+        ]
+        if not candidates:
+            return None
+        # The server's own queue depth includes other users' prompts; our local count
+        # covers prompts the status message has not caught up with yet.
+        return min(candidates, key=lambda c: max(c.queue_remaining, load[c]))
+
+    async def _execute(self, client: AsyncClient, workflow_data: dict) -> dict:
+        job = workflow_data
+        if self.upload_images:
+            workflow_data = await client.upload_inputs(workflow_data)
+        prompt_id = (await client.queue_prompt(workflow_data))["prompt_id"]
+        if self.log:
+            print(f"PROMPT ID: {prompt_id}   Server: {client.server_address}")
+        if self.journal != None:
+            self.journal.record_submitted(job, prompt_id, client.server_address)
+        await client.monitor(prompt_id)
+
+        history = (await client.get_history(prompt_id))[prompt_id]
+        sink = self.output_sink
+        if self.cache != None:
+            sink = self.cache.sink(sink, job)
+        outputs = {}
+        try:
+            with contextlib.closing(
+                output_downloads(history, sink, outputs)
+            ) as downloads:
+                for item, writer in downloads:
+                    async for chunk in client.stream_image(
+                        item["filename"],
+                        item["subfolder"],
+                        item["type"],
+                        sink.chunk_size,
+                    ):
+                        writer.write(chunk)
+        except BaseException:
+            if self.cache != None:
+                self.cache.discard(sink)
+            raise
+        if self.cache != None:
+            self.cache.commit(sink, history)
+        if self.journal != None:
+            self.journal.record_completed(job, prompt_id, history)
+        return outputs
@@ -0,0 +1,4 @@
+import os, sys
+
+# The modules import each other by their top-level names, as in the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
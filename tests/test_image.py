@@ -0,0 +1,21 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+from utils.image import resize_images
+
+
+def test_resize_images_keeps_same_named_sources_apart(tmp_path):
+    paths = []
+    for name, value in (("a", 50), ("b", 200)):
+        (tmp_path / name).mkdir()
+        path = str(tmp_path / name / "img.png")
+        cv2.imwrite(path, np.full((40, 40, 3), value, np.uint8))
+        paths.append(path)
+
+    resized = resize_images(paths, str(tmp_path / "out"), scale=0.5, workers=1)
+
+    assert resized[paths[0]] != resized[paths[1]]
+    assert [cv2.imread(resized[p])[0, 0, 0] for p in paths] == [50, 200]
+    assert cv2.imread(resized[paths[0]]).shape[:2] == (20, 20)
@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+from utils.lazy import benchmark_import
+
+# Wall-clock budget in ms for the import timing check, which is skipped unless set.
+# `python utils/lazy.py` runs the same check with the default 150 ms budget.
+IMPORT_BUDGET_MS = os.environ.get("IMPORT_BUDGET_MS")
+
+
+@pytest.fixture(scope="module")
+def import_results():
+    # Every import is timed in a fresh interpreter.
+    return benchmark_import(repeat=3)
+
+
+@pytest.mark.parametrize("module", ["comfy_helper", "client", "workflow"])
+def test_import_loads_no_heavy_modules(import_results, module):
+    assert import_results[module]["heavy"] == []
+
+
+@pytest.mark.skipif(IMPORT_BUDGET_MS is None, reason="IMPORT_BUDGET_MS is not set")
+@pytest.mark.parametrize("module", ["comfy_helper", "client", "workflow"])
+def test_import_within_budget(import_results, module):
+    assert import_results[module]["best_ms"] < float(IMPORT_BUDGET_MS)
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+pytest.importorskip("ollama")
+
+from utils.llm.prompts import generate_prompts
+
+
+async def _serve(handler):
+    app = web.Application()
+    app.router.add_post("/api/chat", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+def test_generate_prompts_concurrency_and_incremental_writes(tmp_path):
+    output_path = tmp_path / "prompts.txt"
+    concurrency, intervals = 3, 9
+    active = peak = 0
+    lines_on_arrival = []
+
+    async def chat(request):
+        nonlocal active, peak
+        await request.json()
+        n = len(lines_on_arrival)
+        lines_on_arrival.append(len(output_path.read_text().splitlines()))
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.05)
+        active -= 1
+        return web.json_response(
+            {
+                "model": "stub",
+                "created_at": "2024-01-01T00:00:00Z",
+                "message": {"role": "assistant", "content": f"w{n} x{n} y{n} z{n}"},
+                "done": True,
+            }
+        )
+
+    async def run():
+        runner, host = await _serve(chat)
+        try:
+            return await generate_prompts(
+                "seed",
+                "stub",
+                str(output_path),
+                intervals=intervals,
+                concurrency=concurrency,
+                host=host,
+            )
+        finally:
+            await runner.cleanup()
+
+    responses = asyncio.run(run())
+
+    assert len(responses) == intervals
+    assert output_path.read_text().splitlines() == responses
+    assert peak == concurrency
+    # A worker only sends its next request once its last reply is on disk.
+    for k, lines in enumerate(lines_on_arrival):
+        assert lines >= k - concurrency + 1
@@ -0,0 +1,147 @@
+import json, shutil, subprocess
+
+import pytest
+
+from utils import video
+
+needs_ffmpeg = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None,
+    reason="ffmpeg is not installed",
+)
+
+
+def _make_video(path, profile="main", pix_fmt="yuv420p", codec="libx264"):
+    # 4 s at 25 fps with a keyframe every second, and an audio track.
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error"]
+        + ["-f", "lavfi", "-i", "testsrc=size=160x120:rate=25"]
+        + ["-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100"]
+        + ["-t", "4", "-c:v", codec, "-profile:v", profile, "-pix_fmt", pix_fmt]
+        + ["-g", "25", "-keyint_min", "25", "-sc_threshold", "0"]
+        + ["-c:a", "aac", str(path)],
+        check=True,
+    )
+    return str(path)
+
+
+def _probe(path):
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-count_frames", "-select_streams", "v:0"]
+        + ["-show_entries", "stream=profile,level,pix_fmt,nb_read_frames"]
+        + ["-show_entries", "format=duration", "-of", "json", str(path)],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    info = json.loads(out)
+    return info["streams"][0], float(info["format"]["duration"])
+
+
+def _decode_errors(path):
+    return subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", str(path), "-f", "null", "-"],
+        capture_output=True,
+        text=True,
+    ).stderr
+
+
+@needs_ffmpeg
+def test_smart_trim_copies_from_keyframe(tmp_path):
+    source = _make_video(tmp_path / "src.mp4")
+    out = tmp_path / "out.mp4"
+    assert video.smart_trim(source, str(out), 1.0, 3.0) == "copy"
+    assert _probe(out)[1] == pytest.approx(2.0, abs=0.25)
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize(
+    "profile, pix_fmt", [("main", "yuv420p"), ("high444", "yuv444p")]
+)
+def test_smart_trim_head_matches_source(tmp_path, profile, pix_fmt):
+    source = _make_video(tmp_path / "src.mp4", profile, pix_fmt)
+    out = tmp_path / "out.mp4"
+    assert video.smart_trim(source, str(out), 0.3, 2.5) == "smart"
+    src_stream, _ = _probe(source)
+    out_stream, duration = _probe(out)
+    for key in ("profile", "level", "pix_fmt"):
+        assert out_stream[key] == src_stream[key]
+    assert duration == pytest.approx(2.2, abs=0.15)
+    assert _decode_errors(out) == ""
+
+
+@needs_ffmpeg
+def test_smart_trim_output_dir_with_quote(tmp_path):
+    source = _make_video(tmp_path / "src.mp4")
+    (tmp_path / "q'dir").mkdir()
+    out = tmp_path / "q'dir" / "out.mp4"
+    assert video.smart_trim(source, str(out), 0.3, 2.5) == "smart"
+    assert _decode_errors(out) == ""
+
+
+@needs_ffmpeg
+def test_smart_trim_tail_is_copied(tmp_path):
+    source = _make_video(tmp_path / "src.mp4")
+    out = tmp_path / "out.mp4"
+    video.smart_trim(source, str(out), 0.5, 3.0)
+
+    def frame_hashes(*args):
+        out = subprocess.run(
+            ["ffmpeg", "-v", "error"]
+            + list(args)
+            + ["-map", "0:v", "-f", "framemd5"]
+            + ["-"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        return [
+            line.split(",")[-1].strip() for line in out.splitlines() if line[0] != "#"
+        ]
+
+    # Frames 13.. of the output are the source's from the keyframe at 1 s on.
+    tail = frame_hashes("-ss", "1.0", "-i", source, "-t", "2.0")
+    assert frame_hashes("-i", str(out))[12:][: len(tail)] == tail
+
+
+def test_smart_trim_reencodes_unmatched_profile(monkeypatch):
+    calls = []
+    monkeypatch.setattr(video, "keyframe_times", lambda path: [0.0, 1.0, 2.0])
+    monkeypatch.setattr(
+        video,
+        "_stream_info",
+        lambda path: (
+            {
+                "codec_name": "h264",
+                "profile": "Extended",
+                "level": 30,
+                "pix_fmt": "yuv420p",
+                "time_base": "1/12800",
+            },
+            None,
+        ),
+    )
+    monkeypatch.setattr(video, "_run_ffmpeg", calls.append)
+    assert video.smart_trim("in.mp4", "out.mp4", 0.5, 1.5) == "reencode"
+    assert len(calls) == 1
+
+
+def test_head_encoder_args():
+    stream = {
+        "codec_name": "h264",
+        "profile": "High",
+        "level": 41,
+        "pix_fmt": "yuv420p",
+    }
+    assert video._head_encoder_args(stream) == [
+        "-c:v",
+        "libx264",
+        "-profile:v",
+        "high",
+        "-level:v",
+        "4.1",
+        "-pix_fmt",
+        "yuv420p",
+    ]
+    hevc = {"codec_name": "hevc", "profile": "Main 10", "level": 93, "pix_fmt": "x"}
+    assert "level-idc=3.1" in video._head_encoder_args(hevc)
+    assert video._head_encoder_args(dict(stream, codec_name="vp9")) is None
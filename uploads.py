@@ -0,0 +1,143 @@
+import os
+import json
+import uuid
+import hashlib
+import threading
+import mimetypes
+
+# Custom imports
+try:
+    from .workflow import WorkflowJob
+except ImportError:
+    from workflow import WorkflowJob
+
+# Node classes whose `image` input names a file in ComfyUI's input directory.
+IMAGE_INPUT_NODES = ("LoadImage",)
+
+
+class UploadIndex:
+    """
+    Remember which images have already been uploaded to which server.
+
+    Images are keyed by the SHA-256 of their content, so the same picture is uploaded
+    once per server no matter how many jobs or paths refer to it. Hashes are cached by
+    (path, size, mtime) to avoid rereading unchanged files, and the index can be
+    persisted to a JSON lines file so it survives restarts.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            JSON lines file to load from and append to, by default None (memory only)
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._uploaded = {}
+        self._hashes = {}
+        if path != None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._uploaded[(entry["server"], entry["hash"])] = entry["name"]
+
+    def file_hash(self, path: str) -> str:
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if key in self._hashes:
+                return self._hashes[key]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        with self._lock:
+            self._hashes[key] = digest
+        return digest
+
+    def get(self, server_address: str, digest: str):
+        with self._lock:
+            return self._uploaded.get((server_address, digest))
+
+    def add(self, server_address: str, digest: str, name: str):
+        with self._lock:
+            self._uploaded[(server_address, digest)] = name
+            if self.path != None:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    entry = {"server": server_address, "hash": digest, "name": name}
+                    f.write(json.dumps(entry) + "\n")
+
+
+def upload_name(path: str, digest: str) -> str:
+    """
+    Server-side file name for an image, derived from its content so repeated uploads
+    of the same image land on the same file.
+    """
+    return f"{digest[:32]}{os.path.splitext(path)[1].lower()}"
+
+
+def local_images(workflow_data: dict | WorkflowJob) -> list:
+    """
+    Return (node_key, path) for every image input that points at an existing local file.
+    """
+    if isinstance(workflow_data, WorkflowJob):
+        node_keys = workflow_data.workflow.node_keys(list(IMAGE_INPUT_NODES))
+        values = [(k, workflow_data.get_input(k, "image")) for k in node_keys]
+    else:
+        values = [
+            (node_key, node["inputs"].get("image"))
+            for node_key, node in workflow_data.items()
+            if node.get("class_type") in IMAGE_INPUT_NODES
+        ]
+    return [
+        (node_key, value)
+        for node_key, value in values
+        if isinstance(value, str) and os.path.isfile(value)
+    ]
+
+
+def replace_images(workflow_data: dict | WorkflowJob, names: dict):
+    """
+    Return a copy of `workflow_data` with the `image` input of the nodes in `names`
+    replaced. Only the changed nodes are copied.
+    """
+    if isinstance(workflow_data, WorkflowJob):
+        for node_key, name in names.items():
+            workflow_data = workflow_data.with_inputs(node_key, image=name)
+        return workflow_data
+    new_workflow = dict(workflow_data)
+    for node_key, name in names.items():
+        node = dict(new_workflow[node_key])
+        node["inputs"] = dict(node["inputs"], image=name)
+        new_workflow[node_key] = node
+    return new_workflow
+
+
+def encode_multipart(fields: dict, filename: str, content: bytes):
+    """
+    Build a multipart/form-data body for ComfyUI's /upload/image endpoint.
+
+    Returns
+    -------
+    tuple
+        (body, content type header)
+    """
+    boundary = uuid.uuid4().hex
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    parts = []
+    for key, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'
+            f"{value}\r\n".encode("utf-8")
+        )
+    parts.append(
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8")
+    )
+    parts.append(content)
+    parts.append(f"\r\n--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
@@ -1,6 +1,9 @@
-import os, re
+import os, re, time, json, uuid, bisect, random
 from typing import Iterable, Optional
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
 
 
 """
@@ -17,7 +20,9 @@ def rename_files_with_existing_index(
     default_extension: str = "png",
 ):
     """
-    Rename a list of files, will automatically
+    Rename a list of files, will automatically continue the numbering after the highest
+    existing `new_prefix` frame. The renames go through `bulk_rename`, so they either
+    all happen or none do.
 
     Parameters
     ----------
@@ -32,7 +37,7 @@ def rename_files_with_existing_index(
     """
     start_index = max_frame_number(target_dir, new_prefix) + 1
     target_files = dumb_file_search(target_dir, target_prefix)
-    print(target_files)
+    pairs = []
     for file in target_files:
         path = Path(file)
         file_name = path.name
@@ -44,9 +49,163 @@ def rename_files_with_existing_index(
         parent_dir = path.parent
         new_name = f"{new_prefix}{start_index}.{extension}"
         new_path = os.path.join(parent_dir, new_name)
-        print(new_path)
-        os.rename(file, new_path)
+        pairs.append((file, new_path))
         start_index += 1
+    renamed = bulk_rename(pairs)
+    print(f"Renamed {renamed} files")
+
+
+def plan_renames(pairs: Iterable[tuple]) -> list:
+    """
+    Validate a set of (source, destination) renames before any file is touched.
+
+    Renames whose source and destination are equal are dropped. Chains and cycles
+    (a destination that is also a source, e.g. renumbering in place) are allowed, since
+    `bulk_rename` moves every source to a temporary name first.
+
+    Returns
+    -------
+    list
+        The remaining (source, destination) pairs.
+
+    Raises
+    ------
+    FileNotFoundError
+        If a source does not exist.
+    FileExistsError
+        If two renames share a destination, or a destination already exists and is
+        not itself being renamed away.
+    """
+    plan = [
+        (os.path.abspath(src), os.path.abspath(dst))
+        for src, dst in pairs
+        if os.path.abspath(src) != os.path.abspath(dst)
+    ]
+    sources = {src for src, _ in plan}
+    if len(sources) != len(plan):
+        raise ValueError("The same source is renamed twice")
+    destinations = set()
+    for src, dst in plan:
+        if not os.path.exists(src):
+            raise FileNotFoundError(src)
+        if dst in destinations:
+            raise FileExistsError(f"Several files would be renamed to {dst}")
+        if os.path.exists(dst) and dst not in sources:
+            raise FileExistsError(dst)
+        destinations.add(dst)
+    return plan
+
+
+def bulk_rename(
+    pairs: Iterable[tuple], workers: int = 16, journal_path: str = None
+) -> int:
+    """
+    Rename many files at once on a thread pool, all or nothing.
+
+    When destinations overlap sources the renames run in two phases, every source is
+    first moved to a unique temporary name and only then to its destination. The plan
+    and the current phase are written to a journal (fsync'd) before files are moved,
+    so an interrupted run can be finished or undone with `recover_renames`. A failure
+    inside this call is rolled back before the error is re-raised.
+
+    Parameters
+    ----------
+    pairs : Iterable[tuple]
+        (source, destination) paths.
+    workers : int, optional
+        Concurrent renames, mostly useful on network filesystems, by default 16
+    journal_path : str, optional
+        Rollback journal, by default ".bulk_rename.journal" next to the first source
+
+    Returns
+    -------
+    int
+        Number of files renamed.
+    """
+    plan = plan_renames(pairs)
+    if not plan:
+        return 0
+    if journal_path is None:
+        journal_path = os.path.join(os.path.dirname(plan[0][0]), ".bulk_rename.journal")
+    if os.path.exists(journal_path):
+        raise RuntimeError(f"Unfinished rename in {journal_path}, run recover_renames")
+
+    sources = {src for src, _ in plan}
+    two_phase = any(dst in sources for _, dst in plan)
+    token = uuid.uuid4().hex[:8]
+    entries = [
+        [src, os.path.join(os.path.dirname(src), f".{token}-{i}.rename"), dst]
+        for i, (src, dst) in enumerate(plan)
+    ]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if two_phase:
+            _write_rename_journal(journal_path, entries, "temp")
+            done, error = _run_renames(pool, [(s, t) for s, t, _ in entries])
+            if error:
+                _run_renames(pool, [(t, s) for s, t in done])
+                os.remove(journal_path)
+                raise error
+            _write_rename_journal(journal_path, entries, "final")
+            moves = [(t, d) for _, t, d in entries]
+        else:
+            _write_rename_journal(journal_path, entries, "direct")
+            moves = [(s, d) for s, _, d in entries]
+
+        done, error = _run_renames(pool, moves)
+        if error:
+            _run_renames(pool, [(d, t) for t, d in done])
+            if two_phase:
+                _run_renames(pool, [(t, s) for s, t, _ in entries])
+            os.remove(journal_path)
+            raise error
+    os.remove(journal_path)
+    return len(entries)
+
+
+def recover_renames(journal_path: str):
+    """
+    Bring the files of an interrupted `bulk_rename` back to a consistent state.
+
+    If the run had moved every source to its temporary name, the renames are finished.
+    Otherwise they are undone.
+    """
+    with open(journal_path, "r", encoding="utf-8") as f:
+        journal = json.load(f)
+    entries, phase = journal["entries"], journal["phase"]
+    for src, tmp, dst in entries:
+        if phase == "temp" and os.path.exists(tmp):
+            os.rename(tmp, src)
+        elif phase == "final" and os.path.exists(tmp):
+            os.rename(tmp, dst)
+        elif phase == "direct" and os.path.exists(dst) and not os.path.exists(src):
+            os.rename(dst, src)
+    os.remove(journal_path)
+
+
+def _write_rename_journal(journal_path: str, entries: list, phase: str):
+    tmp_path = journal_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"phase": phase, "entries": entries}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, journal_path)
+
+
+def _run_renames(pool: ThreadPoolExecutor, moves: list):
+    """
+    Run `moves` concurrently. Returns the moves that succeeded and the first error.
+    """
+    futures = [(move, pool.submit(os.rename, *move)) for move in moves]
+    done = []
+    error = None
+    for move, future in futures:
+        try:
+            future.result()
+            done.append(move)
+        except OSError as e:
+            error = error or e
+    return done, error
 
 
 """
@@ -74,8 +233,8 @@ def dumb_file_search(source_dir: str, prefix: str) -> list:
         List of matching files.
     """
     paths = []
-    files = os.listdir(source_dir)
-    for file in files:
+    files = frame_index(source_dir, exts=None).names
+    for file in sorted(files, key=natural_sort_key):
         if prefix in file:
             path = os.path.join(source_dir, file)
             paths.append(path)
@@ -93,34 +252,254 @@ def max_frame_number(
     dirpath: str,
     prefix: str,
     divider: str = "",
-    exts: Iterable[str] = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp"),
+    exts: Iterable[str] = IMAGE_EXTS,
 ) -> int:
     """
     Scan a directory (non-recursive) and return the maximum integer that follows `prefix`
     in the filename stem. Ignores files with other prefixes or extensions.
+
+    The directory is listed through a cached `FrameIndex`, so repeated calls only
+    rescan it when it has changed.
+    """
+    return frame_index(dirpath, exts).max_frame(f"{prefix}{divider}")
+
+
+"""
+===================================================================================
+Sorting
+===================================================================================
+"""
+
+_DIGITS_RX = re.compile(r"(\d+)")
+
+
+def natural_sort_key(name: str) -> tuple:
+    """
+    Sort key that orders digit runs numerically, so "frame9" sorts before "frame10"
+    and a digit in the prefix ("clip2_frame10.png") does not decide the order. Only
+    the base name is used and names without digits are fine.
+    """
+    parts = _DIGITS_RX.split(os.path.basename(name))
+    parts[1::2] = map(int, parts[1::2])
+    return tuple(parts)
+
+
+def benchmark_natural_sort(n: int = 100_000) -> dict:
+    """
+    Time sorting `n` shuffled frame names with `natural_sort_key` against the
+    first-number lambda it replaces.
+
+    Returns
+    -------
+    dict
+        Seconds for the lambda and for `natural_sort_key`, and whether the latter
+        restored the original order (the lambda sorts every name by the "2" in
+        "shot2").
+    """
+    names = [f"shot2_frame_{i:06d}.png" for i in range(n)]
+    shuffled = random.sample(names, n)
+
+    start = time.perf_counter()
+    sorted(shuffled, key=lambda s: int(re.search(r"\d+", s).group()))
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ordered = sorted(shuffled, key=natural_sort_key)
+    natural = time.perf_counter() - start
+
+    return {
+        "n": n,
+        "legacy_s": legacy,
+        "natural_s": natural,
+        "ordered": ordered == names,
+    }
+
+
+"""
+===================================================================================
+Frame Index
+===================================================================================
+"""
+
+_FRAME_RX = re.compile(r"^(.*?)(\d+)$")
+
+# Directory mtimes this close to the scan time are not trusted, a file created in
+# the same clock tick as the scan would not change the mtime again.
+_MTIME_SLACK = 2.0
+
+
+class FrameIndex:
+    """
+    Parsed listing of a frame directory.
+
+    The directory is scanned once with `os.scandir` and every file name is split into
+    prefix, frame number and extension ("frame_00012.png" -> "frame_", 12, ".png").
+    Frame numbers are kept sorted per prefix, so max-frame and prefix queries don't
+    touch the filesystem. `refresh` rescans only when the directory's mtime changed and
+    only parses names it has not seen before.
     """
-    if isinstance(dirpath, str):
-        dirpath = Path(dirpath)
 
-    exts = {e.lower() for e in exts}
-    if divider:
-        pattern = rf"^{re.escape(prefix)}{divider}(\d+)$"
+    def __init__(self, dirpath: str, exts: Optional[Iterable[str]] = IMAGE_EXTS):
+        """
+        Parameters
+        ----------
+        dirpath : str
+            Directory to index (non-recursive).
+        exts : Iterable[str] | None, optional
+            Extensions to include, None includes every file, by default IMAGE_EXTS
+        """
+        self.dirpath = str(dirpath)
+        self.exts = {e.lower() for e in exts} if exts != None else None
+        self.names = set()
+        # name -> (prefix, number, ext), number is None for names without digits
+        self._parsed = {}
+        # prefix -> sorted frame numbers
+        self._frames = {}
+        # (prefix, number) -> names, several extensions can share a frame
+        self._by_frame = {}
+        self._mtime_ns = None
+        self._scanned_at = 0.0
+        self.refresh(force=True)
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Bring the index up to date with the directory.
+
+        Returns
+        -------
+        bool
+            True if the directory was rescanned.
+        """
+        st = os.stat(self.dirpath)
+        trusted = self._scanned_at - st.st_mtime > _MTIME_SLACK
+        if not force and st.st_mtime_ns == self._mtime_ns and trusted:
+            return False
+        self._scanned_at = time.time()
+        self._mtime_ns = st.st_mtime_ns
+
+        current = set()
+        with os.scandir(self.dirpath) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                if self.exts != None:
+                    if os.path.splitext(entry.name)[1].lower() not in self.exts:
+                        continue
+                current.add(entry.name)
+        for name in self.names - current:
+            self._remove(name)
+        for name in current - self.names:
+            self._add(name)
+        return True
+
+    def _add(self, name: str):
+        stem, ext = os.path.splitext(name)
+        m = _FRAME_RX.match(stem)
+        if m:
+            prefix, number = m.group(1), int(m.group(2))
+            key = (prefix, number)
+            if key not in self._by_frame:
+                bisect.insort(self._frames.setdefault(prefix, []), number)
+                self._by_frame[key] = []
+            self._by_frame[key].append(name)
+        else:
+            prefix, number = stem, None
+        self._parsed[name] = (prefix, number, ext)
+        self.names.add(name)
+
+    def _remove(self, name: str):
+        prefix, number, _ = self._parsed.pop(name)
+        self.names.discard(name)
+        if number is None:
+            return
+        key = (prefix, number)
+        self._by_frame[key].remove(name)
+        if not self._by_frame[key]:
+            del self._by_frame[key]
+            numbers = self._frames[prefix]
+            del numbers[bisect.bisect_left(numbers, number)]
+            if not numbers:
+                del self._frames[prefix]
+
+    def frames(self, prefix: str) -> list:
+        """
+        Sorted frame numbers that follow exactly `prefix`.
+        """
+        if prefix in self._frames and not prefix[-1:].isdigit():
+            return list(self._frames[prefix])
+        # A prefix ending in a digit ("clip2" in "clip2_7") is split differently by the
+        # parser, fall back to matching the raw names.
+        numbers = set()
+        for name in self.names:
+            rest = os.path.splitext(name)[0][len(prefix) :]
+            if name.startswith(prefix) and rest.isdigit():
+                numbers.add(int(rest))
+        return sorted(numbers)
+
+    def max_frame(self, prefix: str) -> int:
+        """
+        Highest frame number after `prefix`, 0 if there is none.
+        """
+        if prefix in self._frames and not prefix[-1:].isdigit():
+            return self._frames[prefix][-1]
+        numbers = self.frames(prefix)
+        return numbers[-1] if numbers else 0
+
+    def files(self, prefix: str) -> list:
+        """
+        File names with `prefix`, ordered by frame number.
+        """
+        if prefix in self._frames and not prefix[-1:].isdigit():
+            return [
+                name
+                for number in self._frames[prefix]
+                for name in sorted(self._by_frame[(prefix, number)])
+            ]
+        names = [
+            name
+            for name in self.names
+            if name.startswith(prefix)
+            and os.path.splitext(name)[0][len(prefix) :].isdigit()
+        ]
+        return sorted(names, key=lambda n: int(os.path.splitext(n)[0][len(prefix) :]))
+
+    def missing_frames(self, prefix: str, start: int = None, end: int = None) -> list:
+        """
+        Frame numbers between `start` and `end` (inclusive, defaulting to the lowest and
+        highest present) that have no file with `prefix`.
+        """
+        numbers = self.frames(prefix)
+        if not numbers:
+            return []
+        start = numbers[0] if start is None else start
+        end = numbers[-1] if end is None else end
+        present = set(numbers)
+        return [n for n in range(start, end + 1) if n not in present]
+
+    def missing_from(self, other: "FrameIndex") -> list:
+        """
+        Names present in this index but not in `other`.
+        """
+        return [name for name in self.names if name not in other.names]
+
+
+_indexes = {}
+
+
+def frame_index(dirpath: str, exts: Optional[Iterable[str]] = IMAGE_EXTS) -> FrameIndex:
+    """
+    Return a cached `FrameIndex` for `dirpath`, refreshed if the directory changed.
+    """
+    exts_key = tuple(sorted(e.lower() for e in exts)) if exts != None else None
+    key = (os.path.abspath(dirpath), exts_key)
+    index = _indexes.get(key)
+    if index is None:
+        index = FrameIndex(dirpath, exts)
+        _indexes[key] = index
     else:
-        pattern = rf"^{re.escape(prefix)}(\d+)$"
-
-    rx = re.compile(pattern)
-    max_n: Optional[int] = None
-
-    for p in dirpath.iterdir():
-        if not p.is_file():
-            continue
-        if p.suffix.lower() not in exts:
-            continue
-        m = rx.match(p.stem)
-        if not m:
-            continue
-        n = int(m.group(1))
-        if max_n is None or n > max_n:
-            max_n = n
-
-    return max_n or 0
+        index.refresh()
+    return index
+
+
+if __name__ == "__main__":
+    print(benchmark_natural_sort())
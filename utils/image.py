@@ -1,16 +1,45 @@
-import cv2
-import argparse, os
-from PIL import Image
-from pathlib import Path
-import numpy as np
+import argparse, os, json, hashlib, functools, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Custom imports
+try:
+    from .files import IMAGE_EXTS
+    from .lazy import lazy_import
+except ImportError:
+    from files import IMAGE_EXTS
+    from lazy import lazy_import
+
+# Imported on first use
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+
+@functools.lru_cache(maxsize=None)
+def _ellipse(size: int):
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+
+
+def _load_image(image):
+    """
+    Return `image` as a BGR array, reading it from disk if it is a path.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    img = cv2.imread(str(image))
+    if img is None:
+        raise ValueError("Could not load image")
+    return img
 
 
 def apply_mask_to_image(image_path, mask):
     """
     Apply mask to original image - only show masked regions
+
+    `image_path` may also be an already decoded BGR array.
     """
     # Read original image
-    img = cv2.imread(image_path)
+    img = _load_image(image_path)
 
     # Ensure mask is the same size as image
     if mask.shape[:2] != img.shape[:2]:
@@ -29,10 +58,8 @@ def apply_mask_to_image(image_path, mask):
 
 
 def opencv_segmentation_mask(image_path):
-    # Read image
-    img = cv2.imread(image_path)
-    if img is None:
-        raise ValueError("Could not load image")
+    # Read image (or use the array as is)
+    img = _load_image(image_path)
 
     # Convert to LAB color space for better segmentation
     lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
@@ -44,18 +71,15 @@ def opencv_segmentation_mask(image_path):
     _, mask = cv2.threshold(b, 128, 255, cv2.THRESH_BINARY)
 
     # Morphological operations to clean up
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, _ellipse(7))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, _ellipse(7))
 
     return mask
 
 
 def background_subtraction_mask(image_path):
-    # Read image
-    img = cv2.imread(image_path)
-    if img is None:
-        raise ValueError("Could not load image")
+    # Read image (or use the array as is)
+    img = _load_image(image_path)
 
     # Convert to grayscale
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -72,17 +96,14 @@ def background_subtraction_mask(image_path):
     mask = 255 - mask
 
     # Morphological operations
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, _ellipse(5))
 
     return mask
 
 
 def simple_clothing_mask(image_path):
-    # Read image
-    img = cv2.imread(image_path)
-    if img is None:
-        raise ValueError("Could not load image")
+    # Read image (or use the array as is)
+    img = _load_image(image_path)
 
     # Convert BGR to HSV for better color segmentation
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
@@ -107,13 +128,112 @@ def simple_clothing_mask(image_path):
     combined_mask = mask_blue | mask_green | mask_brown
 
     # Apply morphological operations to clean up
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    combined_mask = cv2.morphologyEx(combined_mask, cv2.MORPH_CLOSE, kernel)
-    combined_mask = cv2.morphologyEx(combined_mask, cv2.MORPH_OPEN, kernel)
+    combined_mask = cv2.morphologyEx(combined_mask, cv2.MORPH_CLOSE, _ellipse(5))
+    combined_mask = cv2.morphologyEx(combined_mask, cv2.MORPH_OPEN, _ellipse(5))
 
     return combined_mask
 
 
+MASKS = {
+    "segmentation": opencv_segmentation_mask,
+    "background": background_subtraction_mask,
+    "clothing": simple_clothing_mask,
+}
+
+
+def compute_masks(image, kinds=tuple(MASKS), combine: str = None) -> dict:
+    """
+    Compute several masks of one image, decoding it only once.
+
+    Args:
+        image: Image path or BGR array.
+        kinds: Names from `MASKS` to compute.
+        combine: "or" / "and" to also return the union / intersection of the masks
+                 under "combined", None to skip it.
+
+    Returns:
+        dict: Mask name -> single-channel uint8 mask.
+    """
+    img = _load_image(image)
+    masks = {kind: MASKS[kind](img) for kind in kinds}
+    if combine != None and masks:
+        op = {"or": cv2.bitwise_or, "and": cv2.bitwise_and}[combine]
+        combined = None
+        for mask in masks.values():
+            combined = mask if combined is None else op(combined, mask)
+        masks["combined"] = combined
+    return masks
+
+
+def _mask_file(args):
+    path, output_dir, kinds, combine, save_masks, apply = args
+    img = cv2.imread(path)
+    if img is None:
+        return path, []
+    name = os.path.splitext(os.path.basename(path))[0] + ".png"
+    masks = compute_masks(img, kinds, combine)
+    written = []
+    if save_masks:
+        for kind, mask in masks.items():
+            out = os.path.join(output_dir, kind, name)
+            cv2.imwrite(out, mask)
+            written.append(out)
+    if apply != None:
+        out = os.path.join(output_dir, "masked", name)
+        cv2.imwrite(out, apply_mask_to_image(img, masks[apply]))
+        written.append(out)
+    return path, written
+
+
+def mask_directory(
+    input_dir: str,
+    output_dir: str,
+    kinds=tuple(MASKS),
+    combine: str = "or",
+    save_masks: bool = True,
+    apply: str = "combined",
+    workers: int = None,
+) -> dict:
+    """
+    Compute masks for every image in `input_dir` on a pool of processes.
+
+    Each image is decoded once per worker; its masks go to `<output_dir>/<mask name>/`
+    and, when `apply` names one of them, the masked image to `<output_dir>/masked/`,
+    all as PNG under the source file's name so frame numbering is kept.
+
+    Args:
+        input_dir (str): Directory of source images (non-recursive).
+        output_dir (str): Root directory for the results.
+        kinds: Names from `MASKS` to compute.
+        combine (str): See `compute_masks`.
+        save_masks (bool): Write the masks themselves.
+        apply (str): Mask to apply to the source image, None to skip.
+        workers (int): Worker processes, defaults to the number of CPUs.
+
+    Returns:
+        dict: Source path -> written paths, empty for unreadable images.
+    """
+    paths = sorted(
+        os.path.join(input_dir, name)
+        for name in os.listdir(input_dir)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTS
+    )
+    names = list(kinds) + (["combined"] if combine != None and kinds else [])
+    if save_masks:
+        for name in names:
+            os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+    if apply != None:
+        if apply not in names:
+            raise ValueError(f"Unknown mask {apply!r}")
+        os.makedirs(os.path.join(output_dir, "masked"), exist_ok=True)
+
+    jobs = [(p, output_dir, tuple(kinds), combine, save_masks, apply) for p in paths]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        return dict(executor.map(_mask_file, jobs, chunksize=chunksize))
+
+
 def calc_new_size(
     w,
     h,
@@ -146,22 +266,244 @@ def calc_new_size(
     return w, h
 
 
-def filter_images_by_size(paths: list, max_width: int, max_height: int):
+def filter_images_by_size(
+    paths: list, max_width: int, max_height: int, index: "ImageIndex" = None
+):
     """
     Return paths whose image size is <= max_width and <= max_height.
     Nonexistent or unreadable images are skipped.
+
+    Dimensions come from `index` (a process-wide in-memory `ImageIndex` by default),
+    so repeated calls only read the headers of files that changed.
+    """
+    index = index if index != None else _default_index
+    paths = [str(p) for p in paths]
+    index.update(paths)
+    return index.filter_by_size(max_width, max_height, paths=paths)
+
+
+def _read_header(args):
+    path, with_hash = args
+    try:
+        with Image.open(path) as im:
+            width, height = im.size
+            mode, fmt = im.mode, im.format
+    except Exception:
+        # skip files that can't be opened as images
+        return -1, -1, "", "", ""
+    digest = ""
+    if with_hash:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+    return width, height, mode, fmt, digest
+
+
+class ImageIndex:
+    """
+    Image metadata (size on disk, mtime, width, height, mode, format, content hash)
+    for many files, stored column by column.
+
+    `update` only reads the headers of files whose size or mtime changed, on a pool of
+    threads, so filters, aspect-ratio buckets and duplicate lookups are in-memory
+    queries over numpy columns. Unreadable files are kept with a width and height of
+    -1 and never match a query. The index can be persisted to a JSON file.
     """
-    ok = []
-    for p in map(Path, paths):
-        try:
-            with Image.open(p) as im:
-                w, h = im.size
-            if w <= max_width and h <= max_height:
-                ok.append(str(p))
-        except Exception:
-            # skip files that can't be opened as images
-            continue
-    return ok
+
+    COLUMNS = ("path", "size", "mtime_ns", "width", "height", "mode", "format", "hash")
+
+    def __init__(self, path: str = None, hash_content: bool = True):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            JSON file to load from and `save` to, by default None (memory only)
+        hash_content : bool, optional
+            Hash file contents for `duplicates`, by default True
+        """
+        self.path = path
+        self.hash_content = hash_content
+        self._lock = threading.Lock()
+        self._columns = {name: [] for name in self.COLUMNS}
+        self._rows = {}
+        self._arrays = None
+        if path != None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._columns = json.load(f)
+            self._rows = {p: i for i, p in enumerate(self._columns["path"])}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def update(self, paths, workers: int = 8) -> int:
+        """
+        Index `paths`, rereading only new or modified files.
+
+        Returns
+        -------
+        int
+            Number of files whose headers were read.
+        """
+        stale = []
+        for path in map(str, paths):
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._drop(path)
+                continue
+            row = self._rows.get(path)
+            stat = (st.st_size, st.st_mtime_ns)
+            if (
+                row != None
+                and (
+                    self._columns["size"][row],
+                    self._columns["mtime_ns"][row],
+                )
+                == stat
+            ):
+                continue
+            stale.append((path, stat))
+        if not stale:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            headers = executor.map(
+                _read_header, [(path, self.hash_content) for path, _ in stale]
+            )
+            with self._lock:
+                for (path, stat), header in zip(stale, headers):
+                    self._set(path, stat + header)
+                self._arrays = None
+        return len(stale)
+
+    def scan(self, dirpath: str, workers: int = 8) -> int:
+        """
+        `update` with every image in `dirpath` (non-recursive), dropping entries of
+        that directory whose files are gone.
+        """
+        dirpath = str(dirpath)
+        paths = [
+            os.path.join(dirpath, name)
+            for name in os.listdir(dirpath)
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTS
+        ]
+        present = set(paths)
+        for path in list(self._rows):
+            if os.path.dirname(path) == dirpath and path not in present:
+                self._drop(path)
+        return self.update(paths, workers)
+
+    def _set(self, path: str, values: tuple):
+        row = self._rows.get(path)
+        if row is None:
+            self._rows[path] = len(self._columns["path"])
+            self._columns["path"].append(path)
+            for name, value in zip(self.COLUMNS[1:], values):
+                self._columns[name].append(value)
+        else:
+            for name, value in zip(self.COLUMNS[1:], values):
+                self._columns[name][row] = value
+
+    def _drop(self, path: str):
+        with self._lock:
+            row = self._rows.pop(path, None)
+            if row is None:
+                return
+            # Move the last row into the hole to keep the columns dense.
+            last = len(self._columns["path"]) - 1
+            for column in self._columns.values():
+                column[row] = column[last]
+                column.pop()
+            if row != last:
+                self._rows[self._columns["path"][row]] = row
+            self._arrays = None
+
+    def _numeric(self) -> dict:
+        with self._lock:
+            if self._arrays is None:
+                self._arrays = {
+                    "width": np.asarray(self._columns["width"], dtype=np.int64),
+                    "height": np.asarray(self._columns["height"], dtype=np.int64),
+                }
+            return self._arrays
+
+    def _selection(self, paths) -> "np.ndarray":
+        if paths is None:
+            return np.arange(len(self._columns["path"]))
+        return np.asarray([self._rows[str(p)] for p in paths if str(p) in self._rows])
+
+    def get(self, path: str):
+        """
+        Metadata of one file as a dict, None if it is not indexed.
+        """
+        row = self._rows.get(str(path))
+        if row is None:
+            return None
+        return {name: self._columns[name][row] for name in self.COLUMNS}
+
+    def filter_by_size(
+        self,
+        max_width: int,
+        max_height: int,
+        min_width: int = 0,
+        min_height: int = 0,
+        paths=None,
+    ) -> list:
+        """
+        Indexed images within the size limits, restricted to `paths` (and kept in
+        their order) when given.
+        """
+        arrays = self._numeric()
+        rows = self._selection(paths).astype(np.int64)
+        w, h = arrays["width"][rows], arrays["height"][rows]
+        keep = (w >= max(min_width, 0)) & (h >= max(min_height, 0))
+        keep &= (w <= max_width) & (h <= max_height)
+        return [self._columns["path"][i] for i in rows[keep]]
+
+    def aspect_buckets(self, ratios: list = None, paths=None) -> dict:
+        """
+        Group images by aspect ratio (width / height).
+
+        With `ratios`, every image goes to the nearest of them, otherwise to its own
+        ratio rounded to two decimals.
+        """
+        arrays = self._numeric()
+        rows = self._selection(paths).astype(np.int64)
+        w, h = arrays["width"][rows], arrays["height"][rows]
+        valid = h > 0
+        rows, aspect = rows[valid], w[valid] / h[valid]
+        if ratios:
+            choices = np.asarray(ratios, dtype=np.float64)
+            keys = choices[np.abs(aspect[:, None] - choices[None, :]).argmin(axis=1)]
+        else:
+            keys = np.round(aspect, 2)
+        buckets = {}
+        for key, row in zip(keys.tolist(), rows.tolist()):
+            buckets.setdefault(key, []).append(self._columns["path"][row])
+        return buckets
+
+    def duplicates(self, paths=None) -> list:
+        """
+        Groups of indexed files with identical content, each sorted by path.
+        """
+        groups = {}
+        for row in self._selection(paths).tolist():
+            digest = self._columns["hash"][row]
+            if digest:
+                groups.setdefault(digest, []).append(self._columns["path"][row])
+        return [sorted(g) for g in groups.values() if len(g) > 1]
+
+    def save(self, path: str = None):
+        path = path if path != None else self.path
+        with self._lock:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self._columns, f)
+        os.replace(path + ".tmp", path)
+
+
+_default_index = ImageIndex(hash_content=False)
 
 
 def scale_image(
@@ -190,16 +532,144 @@ def scale_image(
             # im.save(output_path)
             return
 
-        resized = im.resize((nw, nh), resample=Image.LANCZOS)
-        # Preserve format by extension unless format known
-        ext = os.path.splitext(output_path)[1].lower()
-        save_kwargs = {}
-        if ext in {".jpg", ".jpeg", ".png"}:
-            save_kwargs.update({"quality": 95, "optimize": True})
-        resized.save(output_path, **save_kwargs)
+        _save_resized(_resize(im, (nw, nh)), output_path)
         print(f"{w}x{h} -> {nw}x{nh} saved to {output_path}")
 
 
+def _resize(im, size):
+    """
+    LANCZOS resize of a freshly opened image. JPEG downscales let the decoder skip
+    most of the work with `draft()` (DCT scaling by 1/2, 1/4 or 1/8, never below
+    `size`), and large reductions go through `reduce()` first.
+    """
+    if im.format == "JPEG" and size[0] < im.size[0] and size[1] < im.size[1]:
+        im.draft(im.mode, size)
+    return im.resize(size, resample=Image.LANCZOS, reducing_gap=3.0)
+
+
+def _save_resized(resized, output_path: str):
+    # Preserve format by extension unless format known
+    ext = os.path.splitext(output_path)[1].lower()
+    save_kwargs = {}
+    if ext in {".jpg", ".jpeg", ".png"}:
+        save_kwargs.update({"quality": 95, "optimize": True})
+    resized.save(output_path, **save_kwargs)
+
+
+# Sidecar file in the output directory of `resize_images`.
+RESIZE_MANIFEST = ".resize_manifest.json"
+
+
+def _resize_file(args):
+    input_path, output_path, params = args
+    try:
+        with Image.open(input_path) as im:
+            # Only the header has been read at this point.
+            w, h = im.size
+            nw, nh = calc_new_size(w, h, *params)
+            if (nw, nh) == (w, h):
+                return input_path
+            # Keep the extension last so PIL still picks the format from it.
+            root, ext = os.path.splitext(output_path)
+            partial = f"{root}.part{ext}"
+            _save_resized(_resize(im, (nw, nh)), partial)
+        os.replace(partial, output_path)
+        return output_path
+    except OSError:
+        # skip files that can't be opened as images
+        return None
+
+
+def resize_images(
+    paths: list,
+    output_dir: str,
+    scale: float = None,
+    width_preference=None,
+    height_preference=None,
+    no_aspect: bool = False,
+    allow_upscale: bool = True,
+    workers: int = None,
+) -> dict:
+    """
+    Resize many images with the same rules as `scale_image`, on a pool of processes.
+
+    Resized copies keep their file name and go to a subdirectory of `output_dir`
+    named after a hash of the source directory, so same-named images from different
+    directories do not overwrite each other. Images that are already at the target
+    size are not copied, they map to themselves. A manifest in
+    `output_dir` remembers the size and mtime of every source, so sources that have
+    not changed since the last call with the same settings are skipped without being
+    opened.
+
+    Returns:
+        dict: Source path -> path to use (the resized copy or the source itself).
+              Unreadable images are left out.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    params = [scale, width_preference, height_preference, no_aspect, allow_upscale]
+    manifest_path = os.path.join(output_dir, RESIZE_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    results = {}
+    jobs = []
+    stats = {}
+    for path in map(str, paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        key = os.path.abspath(path)
+        stats[key] = [st.st_size, st.st_mtime_ns]
+        entry = manifest.get(key)
+        if (
+            entry != None
+            and entry["stat"] == stats[key]
+            and entry["params"] == params
+            and os.path.exists(entry["output"])
+        ):
+            results[path] = entry["output"]
+            continue
+        subdir = os.path.join(output_dir, _dir_hash(os.path.dirname(key)))
+        os.makedirs(subdir, exist_ok=True)
+        jobs.append((path, os.path.join(subdir, os.path.basename(path)), params))
+
+    if jobs:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(jobs) // (workers * 4))
+            outputs = executor.map(_resize_file, jobs, chunksize=chunksize)
+            for (path, _, _), output in zip(jobs, outputs):
+                if output is None:
+                    continue
+                results[path] = output
+                key = os.path.abspath(path)
+                manifest[key] = {"stat": stats[key], "params": params, "output": output}
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+    return results
+
+
+@functools.lru_cache(maxsize=None)
+def _dir_hash(dirpath: str) -> str:
+    return hashlib.sha1(dirpath.encode("utf-8")).hexdigest()[:16]
+
+
+def resize_directory(input_dir: str, output_dir: str, **kwargs) -> dict:
+    """
+    `resize_images` over every image in `input_dir` (non-recursive).
+    """
+    paths = [
+        os.path.join(input_dir, name)
+        for name in os.listdir(input_dir)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTS
+    ]
+    return resize_images(paths, output_dir, **kwargs)
+
+
 def cli():
     ap = argparse.ArgumentParser(description="Upscale or downscale an image.")
     ap.add_argument("input", help="Input image path")
@@ -0,0 +1,114 @@
+import os, sys, json, types, importlib, subprocess
+
+# Modules that must not be imported by `import comfy_helper` alone.
+HEAVY_MODULES = ("cv2", "numpy", "PIL", "ollama", "aiohttp")
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is only imported on first attribute access.
+
+        cv2 = lazy_import("cv2")
+        cv2.imread(path)  # cv2 is imported here
+
+    Once loaded, the real module's attributes are copied onto the stand-in, so later
+    lookups cost the same as on the module itself.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+            self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+def lazy_import(name: str):
+    """
+    Return `name` itself if it is already imported, otherwise a `LazyModule` for it.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    # One stand-in per name, so every module shares the same load.
+    return _lazy_modules.setdefault(name, LazyModule(name))
+
+
+_lazy_modules = {}
+
+
+def benchmark_import(
+    modules=("comfy_helper", "client", "workflow"), repeat: int = 5
+) -> dict:
+    """
+    Cold-start cost of importing each of `modules` in a fresh interpreter.
+
+    Returns
+    -------
+    dict
+        Module -> {"best_ms": fastest of `repeat` runs, "heavy": the `HEAVY_MODULES`
+        the import pulled in}.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        "import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        "heavy = [m for m in {heavy!r} if m in sys.modules]\n"
+        "print(json.dumps([elapsed, heavy]))\n"
+    )
+    results = {}
+    for module in modules:
+        best, heavy = None, []
+        for _ in range(repeat):
+            out = subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    script.format(module=module, heavy=HEAVY_MODULES),
+                ],
+                cwd=root,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            elapsed, heavy = json.loads(out)
+            best = elapsed if best is None else min(best, elapsed)
+        results[module] = {"best_ms": 1000 * best, "heavy": heavy}
+    return results
+
+
+def check_import_budget(budget_ms: float = 150.0, repeat: int = 5) -> bool:
+    """
+    Print `benchmark_import` results and return False if a core module exceeds
+    `budget_ms` or imports any of `HEAVY_MODULES`.
+    """
+    ok = True
+    for module, result in benchmark_import(repeat=repeat).items():
+        over = result["best_ms"] > budget_ms or result["heavy"]
+        ok = ok and not over
+        status = "FAIL" if over else "ok"
+        print(
+            f"{status:4} {module:14} {result['best_ms']:7.1f} ms"
+            f"  heavy: {', '.join(result['heavy']) or '-'}"
+        )
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_import_budget() else 1)
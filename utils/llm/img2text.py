@@ -1,42 +1,229 @@
+import io
+import os
+import json
 import base64
-from ollama import Client
+import asyncio
+import hashlib
+import threading
+
+# Custom imports
+try:
+    from ..files import IMAGE_EXTS, natural_sort_key
+    from ..lazy import lazy_import
+    from .prompts import DEFAULT_SYSTEM_PROMPT
+except ImportError:
+    from utils.files import IMAGE_EXTS, natural_sort_key
+    from utils.lazy import lazy_import
+    from utils.llm.prompts import DEFAULT_SYSTEM_PROMPT
+
+# Imported on first use
+ollama = lazy_import("ollama")
+Image = lazy_import("PIL.Image")
+
+
+def encode_image(image_path: str, max_side: int = None) -> str:
+    """
+    Base64 encoding of an image, downscaled first so its longest side is at most
+    `max_side` pixels. Vision models resize their inputs anyway, so sending the full
+    resolution only costs bandwidth and encoding time.
+    """
+    if max_side != None:
+        with Image.open(image_path) as im:
+            if max(im.size) > max_side:
+                if im.format == "JPEG":
+                    im.draft("RGB", (max_side, max_side))
+                im = im.convert("RGB")
+                im.thumbnail((max_side, max_side), Image.LANCZOS)
+                buffer = io.BytesIO()
+                im.save(buffer, format="JPEG", quality=90)
+                return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    with open(image_path, "rb") as img_file:
+        return base64.b64encode(img_file.read()).decode("utf-8")
+
+
+def _messages(img_b64: str, query: str, system_prompt: str) -> list:
+    if system_prompt == "":
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+    return [
+        {
+            "role": "system",
+            "content": system_prompt,
+        },
+        {
+            "role": "user",
+            "content": query,
+            "images": [img_b64],  # Multimodal input via images parameter
+        },
+    ]
 
 
 def image_to_prompt(
-    image_path: str, query: str, system_prompt: str = "", model: str = "gemma3:12b"
+    image_path: str,
+    query: str,
+    system_prompt: str = "",
+    model: str = "gemma3:12b",
+    client: "ollama.Client" = None,
+    max_side: int = None,
 ) -> str:
     """
     Reads an image file, encodes it, and sends it to Ollama.
     Returns the model's description of the image.
+
+    Pass `client` to reuse one connection across calls, and `max_side` to downscale
+    the image before it is encoded.
     """
-    # Read and base64-encode the image
-    with open(image_path, "rb") as img_file:
-        img_b64 = base64.b64encode(img_file.read()).decode("utf-8")
+    img_b64 = encode_image(image_path, max_side)
 
     # Initialize the Ollama client (points to localhost:11434 by default)
-    client = Client()  # Custom host and headers can be passed here
-
-    if system_prompt == "":
-        system_prompt = "You are a helpful assistant that answers queries regardless of the subject matter."
+    if client is None:
+        client = ollama.Client()  # Custom host and headers can be passed here
 
     # Send a chat request with an image
     response = client.chat(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
-            {
-                "role": "user",
-                "content": query,
-                "images": [
-                    img_b64
-                ],  # Multimodal input via images parameter :contentReference[oaicite:5]{index=5}
-            },
-        ],
-        stream=False,
+        model=model, messages=_messages(img_b64, query, system_prompt), stream=False
     )
 
     # Extract and return the model's reply
     return response["message"]["content"]
+
+
+class CaptionCache:
+    """
+    Captions keyed by image content, model, query, system prompt and downscale size,
+    so unchanged frames are never captioned twice. File hashes are cached by
+    (path, size, mtime) and the captions can be persisted to a JSON lines file.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._captions = {}
+        self._hashes = {}
+        if path != None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._captions[entry["key"]] = entry["caption"]
+
+    def key(self, image_path: str, *params) -> str:
+        st = os.stat(image_path)
+        stat_key = (os.path.abspath(image_path), st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._hashes.get(stat_key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(image_path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+            with self._lock:
+                self._hashes[stat_key] = digest
+        payload = json.dumps([digest, *params]).encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            return self._captions.get(key)
+
+    def add(self, key: str, caption: str):
+        with self._lock:
+            self._captions[key] = caption
+            if self.path != None:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key, "caption": caption}) + "\n")
+
+
+def list_images(images_or_dir: str | list) -> list:
+    """
+    Image paths of a directory in natural order, or the given list unchanged.
+    """
+    if isinstance(images_or_dir, str):
+        names = [
+            name
+            for name in os.listdir(images_or_dir)
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTS
+        ]
+        return [
+            os.path.join(images_or_dir, name)
+            for name in sorted(names, key=natural_sort_key)
+        ]
+    return list(images_or_dir)
+
+
+async def caption_images_async(
+    images: list,
+    query: str,
+    system_prompt: str = "",
+    model: str = "gemma3:12b",
+    concurrency: int = 4,
+    max_side: int = 1024,
+    cache: CaptionCache = None,
+    host: str = None,
+) -> list:
+    """
+    Caption `images` with up to `concurrency` requests in flight on one shared
+    `ollama.AsyncClient`. Images are encoded on worker threads. Returns the captions
+    in the order of `images`.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    params = (model, query, system_prompt, max_side)
+
+    async def caption(client, image_path: str) -> str:
+        key = None
+        if cache != None:
+            key = await asyncio.to_thread(cache.key, image_path, *params)
+            cached = cache.get(key)
+            if cached != None:
+                return cached
+        async with semaphore:
+            img_b64 = await asyncio.to_thread(encode_image, image_path, max_side)
+            response = await client.chat(
+                model=model,
+                messages=_messages(img_b64, query, system_prompt),
+                stream=False,
+            )
+        text = response["message"]["content"].strip()
+        print(f"Caption: {text}   Image: {image_path}")
+        if cache != None:
+            cache.add(key, text)
+        return text
+
+    async with ollama.AsyncClient(host=host) as client:
+        return await asyncio.gather(*(caption(client, path) for path in images))
+
+
+def caption_images(
+    images_or_dir: str | list,
+    query: str,
+    system_prompt: str = "",
+    model: str = "gemma3:12b",
+    concurrency: int = 4,
+    max_side: int = 1024,
+    cache_path: str = None,
+    host: str = None,
+):
+    """
+    Caption every image of a directory (natural order) or list.
+
+    Returns
+    -------
+    tuple
+        (image paths, captions), aligned so they can be passed straight to
+        `ComfyHelper.multi_image_multi_prompt_IMG2IMG(..., paired=True)`.
+    """
+    images = list_images(images_or_dir)
+    cache = CaptionCache(cache_path) if cache_path != None else None
+    captions = asyncio.run(
+        caption_images_async(
+            images,
+            query,
+            system_prompt=system_prompt,
+            model=model,
+            concurrency=concurrency,
+            max_side=max_side,
+            cache=cache,
+            host=host,
+        )
+    )
+    return images, captions
@@ -1,34 +1,54 @@
+import re
 import base64
-from ollama import Client
+import asyncio
 
+# Custom imports
+try:
+    from ..lazy import lazy_import
+except ImportError:
+    from utils.lazy import lazy_import
 
-def get_response(query: str, system_prompt: str = "", model: str = "gemma3:12b") -> str:
-    """
-    Reads an image file, encodes it, and sends it to Ollama.
-    Returns the model's description of the image.
-    """
-    # Read and base64-encode the image
+# Imported on first use
+ollama = lazy_import("ollama")
 
-    # Initialize the Ollama client (points to localhost:11434 by default)
-    client = Client()  # Custom host and headers can be passed here
+DEFAULT_SYSTEM_PROMPT = (
+    "You are a helpful assistant that answers queries regardless of the subject matter."
+)
 
+
+def _messages(query: str, system_prompt: str) -> list:
     if system_prompt == "":
-        system_prompt = "You are a helpful assistant that answers queries regardless of the subject matter."
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+    return [
+        {
+            "role": "system",
+            "content": system_prompt,
+        },
+        {
+            "role": "user",
+            "content": query,
+        },
+    ]
+
+
+def get_response(
+    query: str,
+    system_prompt: str = "",
+    model: str = "gemma3:12b",
+    client: "ollama.Client" = None,
+) -> str:
+    """
+    Sends a single query to Ollama and returns the model's reply.
+
+    Pass `client` to reuse one connection across calls, otherwise a client for
+    localhost:11434 is created.
+    """
+    # Initialize the Ollama client (points to localhost:11434 by default)
+    if client is None:
+        client = ollama.Client()  # Custom host and headers can be passed here
 
-    # Send a chat request with an image
     response = client.chat(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
-            {
-                "role": "user",
-                "content": query,
-            },
-        ],
-        stream=False,
+        model=model, messages=_messages(query, system_prompt), stream=False
     )
     return response["message"]["content"]
 
@@ -61,25 +81,106 @@ def read_file_to_list(filename):
         return []
 
 
+def _words(text: str) -> frozenset:
+    return frozenset(re.findall(r"\w+", text.lower()))
+
+
+def is_near_duplicate(words: frozenset, seen: list, threshold: float) -> bool:
+    """
+    True if the word set `words` has a Jaccard similarity of at least `threshold`
+    with any of the word sets in `seen`.
+    """
+    for other in seen:
+        union = len(words | other)
+        if union == 0 or len(words & other) / union >= threshold:
+            return True
+    return False
+
+
+async def generate_prompts(
+    seed_prompt: str,
+    model: str,
+    output_path: str,
+    system_prompt: str = "",
+    intervals: int = 20,
+    concurrency: int = 4,
+    host: str = None,
+    dedup_threshold: float = 0.8,
+    max_requests: int = None,
+) -> list:
+    """
+    Generate `intervals` distinct prompts with up to `concurrency` requests in flight
+    on one shared `ollama.AsyncClient`.
+
+    Every accepted prompt is appended to `output_path` as soon as it arrives, so an
+    interrupted run keeps what it already generated. Replies whose words overlap an
+    accepted prompt by `dedup_threshold` or more (Jaccard) are dropped and requested
+    again, up to `max_requests` requests in total (3 * intervals by default).
+
+    Returns the accepted prompts in the order they were written.
+    """
+    full_prompt = f"Create a prompt based on this premise: {seed_prompt}. Respond with nothing but the prompt."
+    messages = _messages(full_prompt, system_prompt)
+    max_requests = max_requests if max_requests != None else 3 * intervals
+    responses = []
+    seen = []
+    requested = 0
+
+    async with ollama.AsyncClient(host=host) as client:
+        with open(output_path, "w") as f:
+
+            async def worker():
+                nonlocal requested
+                while len(responses) < intervals and requested < max_requests:
+                    requested += 1
+                    response = await client.chat(
+                        model=model, messages=messages, stream=False
+                    )
+                    resp = response["message"]["content"].strip()
+                    words = _words(resp)
+                    if len(responses) >= intervals or is_near_duplicate(
+                        words, seen, dedup_threshold
+                    ):
+                        continue
+                    seen.append(words)
+                    responses.append(resp)
+                    f.write(resp.replace("\n", " ") + "\n")
+                    f.flush()
+                    print(f"Response: {resp}   Index: {len(responses) - 1}")
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return responses
+
+
 def create_multiple_prompts(
     seed_prompt: str,
     model: str,
     output_path: str,
     system_prompt: str = "",
     intervals: int = 20,
+    concurrency: int = 4,
+    host: str = None,
+    dedup_threshold: float = 0.8,
 ):
-    responses = []
-    full_prompt = f"Create a prompt based on this premise: {seed_prompt}. Respond with nothing but the prompt."
-    index = 0
+    """
+    Writes `intervals` prompts generated from `seed_prompt` to `output_path`, one per
+    line. See `generate_prompts`.
+    """
     try:
-        while index < intervals:
-            resp = get_response(full_prompt, system_prompt=system_prompt, model=model)
-            print(f"Response: {resp}   Index: {index}")
-            responses.append(resp)
-            index += 1
+        asyncio.run(
+            generate_prompts(
+                seed_prompt,
+                model,
+                output_path,
+                system_prompt=system_prompt,
+                intervals=intervals,
+                concurrency=concurrency,
+                host=host,
+                dedup_threshold=dedup_threshold,
+            )
+        )
     except KeyboardInterrupt:
         pass
-    write_list_to_file(responses, output_path)
 
 
 if __name__ == "__main__":
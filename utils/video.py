@@ -1,41 +1,375 @@
-import cv2, os, shlex, subprocess
-from typing import Union
+import os, re, json, shlex, bisect, tempfile, threading, subprocess
+from typing import Iterator, Tuple, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+# Custom imports
+try:
+    from .files import IMAGE_EXTS, frame_index
+    from .lazy import lazy_import
+except ImportError:
+    from files import IMAGE_EXTS, frame_index
+    from lazy import lazy_import
 
-def split_video_to_frames(video_path, output_dir, step=30, prefix="frame"):
+# Imported on first use
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+
+# cv2 encoder parameter and default value for each output format of
+# split_video_to_frames.
+FRAME_FORMATS = {
+    "png": ("IMWRITE_PNG_COMPRESSION", 3),
+    "jpg": ("IMWRITE_JPEG_QUALITY", 95),
+    "webp": ("IMWRITE_WEBP_QUALITY", 95),
+    "npy": (None, None),
+}
+
+
+def split_video_to_frames(
+    video_path,
+    output_dir,
+    step=30,
+    prefix="frame",
+    backend="grab",
+    fmt="png",
+    quality=None,
+    workers=None,
+):
     """
     Split a video into frames every X frames and save them to a directory.
 
+    Frames are decoded on the calling thread and encoded/written on a pool of worker
+    threads (OpenCV releases the GIL while encoding). At most `2 * workers` frames wait
+    for a worker at any time, so memory stays bounded when decoding outpaces encoding.
+
     Args:
         video_path (str): Path to the input video file (e.g., "video.mp4").
         output_dir (str): Directory to save extracted frames.
         step (int): Save one frame every `step` frames.
         prefix (str): Prefix for saved frame filenames.
+        backend (str): Frame extraction backend, see `iter_frames`.
+        fmt (str): "png", "jpg", "webp" or "npy" (raw array, no encoding).
+        quality (int): PNG compression level (0-9) or JPEG/WebP quality (0-100).
+                       Defaults to PNG level 3 and quality 95.
+        workers (int): Encoding threads, defaults to the number of CPUs.
+
+    Returns:
+        int: Number of frames written.
     """
+    if fmt not in FRAME_FORMATS:
+        raise ValueError(f"Unknown frame format {fmt!r}")
+    flag, default = FRAME_FORMATS[fmt]
+    params = []
+    if flag != None:
+        params = [getattr(cv2, flag), default if quality is None else int(quality)]
+    workers = workers or os.cpu_count() or 1
+
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
 
-    # Open video
+    def write(frame_filename, frame):
+        if fmt == "npy":
+            np.save(frame_filename, frame)
+            return
+        ok, buffer = cv2.imencode("." + fmt, frame, params)
+        if not ok:
+            raise IOError(f"Cannot encode {frame_filename}")
+        with open(frame_filename, "wb") as f:
+            f.write(buffer)
+
+    slots = threading.BoundedSemaphore(2 * workers)
+    futures = deque()
+    saved_count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for saved_count, (_, frame) in enumerate(
+            iter_frames(video_path, step, backend), start=1
+        ):
+            frame_filename = os.path.join(
+                output_dir, f"{prefix}_{saved_count - 1:05d}.{fmt}"
+            )
+            slots.acquire()
+            future = executor.submit(write, frame_filename, frame)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+            # Surface encoding errors early instead of after the whole video.
+            while futures and futures[0].done():
+                futures.popleft().result()
+        for future in futures:
+            future.result()
+    return saved_count
+
+
+def iter_frames(
+    video_path: str, step: int = 1, backend: str = "grab"
+) -> Iterator[Tuple[int, "np.ndarray"]]:
+    """
+    Yield `(index, frame)` for every `step`th frame of a video, where `index` is the
+    frame's position in the source and `frame` a BGR array, without writing anything
+    to disk.
+
+    Args:
+        video_path (str): Path to the input video file.
+        step (int): Keep one frame every `step` frames.
+        backend (str):
+            "grab"   - decode sequentially but only convert the kept frames
+                       (`grab()` without `retrieve()` for the skipped ones).
+            "seek"   - jump straight to each kept frame. Fastest for large steps on
+                       codecs with frequent keyframes, slower for small steps.
+            "ffmpeg" - let ffmpeg's `select` filter drop frames and pipe raw BGR
+                       frames back, decoding on ffmpeg's own threads.
+    """
+    if step < 1:
+        raise ValueError("step must be at least 1")
+    if backend == "ffmpeg":
+        yield from _iter_frames_ffmpeg(video_path, step)
+        return
+
     cap = cv2.VideoCapture(video_path)
     if not cap.isOpened():
         raise IOError(f"Cannot open video file {video_path}")
+    try:
+        if backend == "grab":
+            index = 0
+            while cap.grab():
+                if index % step == 0:
+                    ret, frame = cap.retrieve()
+                    if not ret:
+                        break
+                    yield index, frame
+                index += 1
+        elif backend == "seek":
+            total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            for index in range(0, total, step):
+                if index and step > 1:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield index, frame
+        else:
+            raise ValueError(f"Unknown backend {backend!r}")
+    finally:
+        cap.release()
 
-    frame_count = 0
-    saved_count = 0
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # End of video
+def _iter_frames_ffmpeg(video_path: str, step: int):
+    info = probe_video(video_path)
+    width, height = info["width"], info["height"]
+    cmd = [
+        "ffmpeg",
+        "-v",
+        "error",
+        "-i",
+        video_path,
+        "-vf",
+        f"select=not(mod(n\\,{step}))",
+        "-vsync",
+        "0",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "pipe:1",
+    ]
+    frame_size = width * height * 3
+    # ffmpeg's messages go to a file, a pipe nobody reads would fill up and stall it.
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+    try:
+        k = 0
+        while True:
+            buffer = proc.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+            yield k * step, np.frombuffer(buffer, np.uint8).reshape(height, width, 3)
+            k += 1
+        if proc.wait() != 0 or buffer:
+            stderr.seek(0)
+            message = stderr.read().decode("utf-8", "replace")
+            if not message:
+                message = f"truncated frame ({len(buffer)} of {frame_size} bytes)"
+            raise RuntimeError(f"ffmpeg failed on {video_path}:\n{message}")
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        stderr.close()
+
+
+def probe_video(video_path: str) -> dict:
+    """
+    Read the first video stream's width, height, frame rate and rotation with ffprobe.
+    Width and height are those of the frames as ffmpeg outputs them, i.e. swapped
+    for videos rotated by 90 or 270 degrees, which ffmpeg turns upright.
+    """
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=width,height,r_frame_rate:stream_tags=rotate"
+        ":stream_side_data=rotation",
+        "-of",
+        "json",
+        video_path,
+    ]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffprobe failed:\n{proc.stderr}")
+    stream = json.loads(proc.stdout)["streams"][0]
+    num, den = stream["r_frame_rate"].split("/")
+    # Older muxers store a "rotate" tag, newer ones a display matrix.
+    rotation = stream.get("tags", {}).get("rotate", 0)
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    rotation = int(float(rotation)) % 360
+    width, height = int(stream["width"]), int(stream["height"])
+    if rotation % 180 == 90:
+        width, height = height, width
+    return {
+        "width": width,
+        "height": height,
+        "fps": float(num) / float(den),
+        "r_frame_rate": stream["r_frame_rate"],
+        "rotation": rotation,
+    }
+
 
-        if frame_count % step == 0:  # Save every Xth frame
-            frame_filename = os.path.join(output_dir, f"{prefix}_{saved_count:05d}.png")
-            cv2.imwrite(frame_filename, frame)
-            saved_count += 1
+def frames_to_video(
+    frames_dir: str,
+    output_path: str,
+    prefix: str = "frame",
+    source_video: str = None,
+    step: int = 1,
+    fps: float = None,
+    codec: str = "libx264",
+    crf: int = 18,
+    workers: int = 2,
+) -> int:
+    """
+    Encode the numbered frames of `frames_dir` into a video. Frame names are
+    `<prefix><number>`, optionally with a "_" before or after the number, so
+    "frame_00012.png" and ComfyUI's "frame_00012_.png" both match `prefix="frame"`.
 
-        frame_count += 1
+    Frames are decoded a few at a time and piped to ffmpeg as raw BGR data in frame
+    number order, so memory use does not depend on the length of the clip and no
+    intermediate file list is written. Frames whose size differs from the first one
+    are resized to match.
+
+    Args:
+        frames_dir (str): Directory holding the frames (images or .npy arrays).
+        output_path (str): Video file to write.
+        prefix (str): Frame name prefix (e.g. "frame" or "frame_" for
+                      "frame_00012.png").
+        source_video (str): Video the frames were extracted from. Its frame rate is
+                            used and its audio track, if any, is copied over.
+        step (int): The `step` the frames were extracted with, the output frame rate
+                    is the source's divided by it.
+        fps (float): Output frame rate, overrides the one taken from `source_video`.
+                     Defaults to 30 when neither is given.
+        codec (str): ffmpeg video encoder.
+        crf (int): Constant rate factor passed to the encoder.
+        workers (int): Frames decoded ahead of the encoder.
 
-    cap.release()
+    Returns:
+        int: Number of frames written.
+    """
+    names = _frame_files(frames_dir, prefix)
+    if not names:
+        raise FileNotFoundError(f"No frames with prefix {prefix!r} in {frames_dir}")
+    paths = [os.path.join(frames_dir, name) for name in names]
+
+    if fps != None:
+        rate = str(fps)
+    elif source_video != None:
+        num, den = probe_video(source_video)["r_frame_rate"].split("/")
+        rate = f"{num}/{int(den) * step}"
+    else:
+        rate = "30"
+
+    first = _load_frame(paths[0])
+    height, width = first.shape[:2]
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-v",
+        "error",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "-s",
+        f"{width}x{height}",
+        "-r",
+        rate,
+        "-i",
+        "pipe:0",
+    ]
+    if source_video != None:
+        cmd += ["-i", source_video, "-map", "0:v:0", "-map", "1:a:0?", "-c:a", "aac"]
+        cmd += ["-shortest"]
+    cmd += ["-c:v", codec, "-crf", str(crf), "-pix_fmt", "yuv420p", output_path]
+
+    def load(path):
+        frame = _load_frame(path)
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        return np.ascontiguousarray(frame, dtype=np.uint8)
+
+    # ffmpeg's messages go to a file, a pipe nobody reads would fill up and stall it.
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=stderr)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            ahead = deque()
+            for path in paths:
+                ahead.append(executor.submit(load, path))
+                if len(ahead) > workers:
+                    proc.stdin.write(ahead.popleft().result().data)
+            while ahead:
+                proc.stdin.write(ahead.popleft().result().data)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        stderr.close()
+        raise
+    returncode = proc.wait()
+    stderr.seek(0)
+    message = stderr.read().decode("utf-8", "replace")
+    stderr.close()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed:\n{message}")
+    return len(paths)
+
+
+def _frame_files(frames_dir: str, prefix: str) -> list:
+    """
+    Names of the frames of `frames_dir` matching `prefix` (see `frames_to_video`),
+    ordered by frame number.
+    """
+    pattern = re.compile(re.escape(prefix) + r"_?(\d+)_?$")
+    numbered = []
+    for name in frame_index(frames_dir, IMAGE_EXTS + (".npy",)).names:
+        m = pattern.match(os.path.splitext(name)[0])
+        if m:
+            numbered.append((int(m.group(1)), name))
+    return [name for _, name in sorted(numbered)]
+
+
+def _load_frame(path: str) -> "np.ndarray":
+    if path.lower().endswith(".npy"):
+        return np.load(path)
+    frame = cv2.imread(path, cv2.IMREAD_COLOR)
+    if frame is None:
+        raise IOError(f"Cannot read frame {path}")
+    return frame
 
 
 def _to_seconds(ts: Union[str, int, float]) -> float:
@@ -100,6 +434,248 @@ def trim_video_ffmpeg(
         raise RuntimeError(f"ffmpeg failed:\n{proc.stderr}")
 
 
+"""
+===================================================================================
+Batch trimming
+===================================================================================
+"""
+
+# Encoders able to produce a head segment that concatenates with stream-copied video.
+_SMART_CUT_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+
+# ffprobe profile name -> encoder profile, per codec. Sources in other profiles are
+# re-encoded in full since a head in a different profile cannot be joined to them.
+_SMART_CUT_PROFILES = {
+    "h264": {
+        "Constrained Baseline": "baseline",
+        "Baseline": "baseline",
+        "Main": "main",
+        "High": "high",
+        "High 10": "high10",
+        "High 4:2:2": "high422",
+        "High 4:4:4 Predictive": "high444",
+    },
+    "hevc": {"Main": "main", "Main 10": "main10"},
+}
+
+# Bitstream filter that puts the parameter sets in-band for the MPEG-TS parts.
+_ANNEXB_FILTERS = {"h264": "h264_mp4toannexb", "hevc": "hevc_mp4toannexb"}
+
+# Containers that take -video_track_timescale.
+_MOV_EXTS = (".mp4", ".m4v", ".mov")
+
+_keyframe_cache = {}
+_keyframe_lock = threading.Lock()
+
+
+def keyframe_times(video_path: str) -> list:
+    """
+    Sorted presentation times (seconds) of the keyframes of the first video stream.
+
+    Read from packet flags with ffprobe, so nothing is decoded. Cached per file until
+    its size or mtime changes.
+    """
+    st = os.stat(video_path)
+    key = (os.path.abspath(video_path), st.st_size, st.st_mtime_ns)
+    with _keyframe_lock:
+        if key in _keyframe_cache:
+            return _keyframe_cache[key]
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+        video_path,
+    ]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffprobe failed:\n{proc.stderr}")
+    times = []
+    for line in proc.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            times.append(float(pts))
+    times.sort()
+    with _keyframe_lock:
+        _keyframe_cache[key] = times
+    return times
+
+
+def _stream_info(video_path: str) -> tuple:
+    """
+    The first video and first audio stream of `video_path` as ffprobe reports them,
+    None for a missing stream.
+    """
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "stream=codec_type,codec_name,profile,level,pix_fmt,time_base",
+        "-of",
+        "json",
+        video_path,
+    ]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffprobe failed:\n{proc.stderr}")
+    streams = json.loads(proc.stdout)["streams"]
+    video = next((s for s in streams if s["codec_type"] == "video"), None)
+    audio = next((s for s in streams if s["codec_type"] == "audio"), None)
+    return video, audio
+
+
+def _head_encoder_args(video: dict) -> list:
+    """
+    Encoder arguments that reproduce the codec, profile, level and pixel format of
+    the stream `video`, or None if they cannot be matched.
+    """
+    codec = video.get("codec_name")
+    profile = _SMART_CUT_PROFILES.get(codec, {}).get(video.get("profile"))
+    level = video.get("level", -1)
+    if profile is None or level <= 0 or "pix_fmt" not in video:
+        return None
+    args = ["-c:v", _SMART_CUT_ENCODERS[codec], "-profile:v", profile]
+    if codec == "h264":
+        args += ["-level:v", f"{level / 10:g}"]
+    else:
+        args += ["-x265-params", f"level-idc={level / 30:g}"]
+    return args + ["-pix_fmt", video["pix_fmt"]]
+
+
+def _run_ffmpeg(args: list):
+    proc = subprocess.run(
+        ["ffmpeg", "-y", "-v", "error"] + args, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed:\n{proc.stderr}")
+
+
+def smart_trim(
+    input_path: str,
+    output_path: str,
+    start: Union[str, int, float],
+    end: Union[str, int, float],
+    tolerance: float = 0.05,
+    crf: int = 18,
+) -> str:
+    """
+    Trim `input_path` between `start` and `end`, re-encoding as little as possible.
+
+    - start within `tolerance` seconds of a keyframe: stream copy.
+    - otherwise the video before the first keyframe after `start` is re-encoded with
+      the source's codec, profile, level and pixel format and the rest is
+      stream-copied. Both parts go through MPEG-TS files with in-band parameter sets
+      and are joined with the concat demuxer; the audio is re-encoded in one piece.
+    - segments without a keyframe, or sources whose parameters cannot be matched,
+      are re-encoded in full.
+
+    Returns:
+        str: "copy", "smart" or "reencode", the method that was used.
+    """
+    s = _to_seconds(start)
+    e = _to_seconds(end)
+    if e <= s:
+        raise ValueError("end must be greater than start")
+
+    keyframes = keyframe_times(input_path)
+    i = bisect.bisect_left(keyframes, s - tolerance)
+    keyframe = keyframes[i] if i < len(keyframes) else None
+
+    if keyframe != None and abs(keyframe - s) <= tolerance:
+        _run_ffmpeg(
+            ["-ss", f"{keyframe:.6f}", "-i", input_path, "-t", f"{e - keyframe:.6f}"]
+            + [
+                "-map",
+                "0",
+                "-c",
+                "copy",
+                "-avoid_negative_ts",
+                "make_zero",
+                output_path,
+            ]
+        )
+        return "copy"
+
+    video, _ = _stream_info(input_path)
+    head_args = _head_encoder_args(video) if video != None else None
+    if keyframe is None or keyframe >= e or head_args is None:
+        encoder = _SMART_CUT_ENCODERS.get(video and video["codec_name"], "libx264")
+        _run_ffmpeg(
+            ["-ss", f"{s:.6f}", "-i", input_path, "-t", f"{e - s:.6f}"]
+            + ["-c:v", encoder, "-crf", str(crf), "-c:a", "aac", output_path]
+        )
+        return "reencode"
+
+    mux_args = []
+    if os.path.splitext(output_path)[1].lower() in _MOV_EXTS:
+        timescale = video["time_base"].split("/")[1]
+        mux_args = ["-video_track_timescale", timescale]
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(output_path))
+    ) as tmp:
+        head = os.path.join(tmp, "head.ts")
+        tail = os.path.join(tmp, "tail.ts")
+        _run_ffmpeg(
+            ["-ss", f"{s:.6f}", "-i", input_path, "-t", f"{keyframe - s:.6f}"]
+            + ["-map", "0:v:0", "-vsync", "0"]
+            + head_args
+            + ["-crf", str(crf), "-f", "mpegts", head]
+        )
+        _run_ffmpeg(
+            ["-ss", f"{keyframe:.6f}", "-i", input_path, "-t", f"{e - keyframe:.6f}"]
+            + ["-map", "0:v:0", "-c", "copy"]
+            + ["-bsf:v", _ANNEXB_FILTERS[video["codec_name"]], "-f", "mpegts", tail]
+        )
+        # The head's duration places the tail exactly `keyframe - s` after the start.
+        # Names are relative to the list, so quotes in the output's directory cannot
+        # break its syntax.
+        concat_list = os.path.join(tmp, "concat.txt")
+        with open(concat_list, "w", encoding="utf-8") as f:
+            f.write(f"file 'head.ts'\nduration {keyframe - s:.6f}\nfile 'tail.ts'\n")
+        _run_ffmpeg(
+            ["-f", "concat", "-safe", "0", "-i", concat_list]
+            + ["-ss", f"{s:.6f}", "-t", f"{e - s:.6f}", "-i", input_path]
+            + ["-map", "0:v", "-map", "1:a:0?", "-c:v", "copy", "-c:a", "aac"]
+            + mux_args
+            + [output_path]
+        )
+    return "smart"
+
+
+def trim_videos(segments, workers: int = None, tolerance: float = 0.05) -> list:
+    """
+    Cut many clips at once with `smart_trim`.
+
+    Each ffmpeg/ffprobe call is its own process, so the pool only needs threads to
+    keep `workers` of them running. Keyframes are probed once per input file.
+
+    Args:
+        segments: Iterable of (input_path, output_path, start, end).
+        workers (int): Concurrent trims, defaults to the number of CPUs.
+        tolerance (float): See `smart_trim`.
+
+    Returns:
+        list: The method used for each segment ("copy", "smart" or "reencode"), in
+              input order.
+    """
+    segments = list(segments)
+    workers = workers or os.cpu_count() or 1
+    # Probe every input once up front instead of racing on the cache.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(keyframe_times, {seg[0] for seg in segments}))
+        futures = [
+            executor.submit(smart_trim, *segment, tolerance=tolerance)
+            for segment in segments
+        ]
+        return [future.result() for future in futures]
+
+
 if __name__ == "__main__":
 
     INPUT = "test.mp4"
@@ -1,10 +1,42 @@
-import json, secrets
+import json, hashlib, secrets, sys, time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Node classes filled by `edit_workflow`.
+PROMPT_NODES = ["CLIPTextEncode", "TextEncodeQwenImageEdit"]
+IMAGE_NODES = ["LoadImage"]
+SAVE_NODES = ["SaveImage", "VHS_VideoCombine"]
+KSAMPLER_NODES = ["KSampler", "KSamplerAdvanced"]
+
+
+def _dumps(obj) -> bytes:
+    if orjson != None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def encode_prompt(prompt, client_id: str) -> bytes:
+    """
+    Encode the body of a /prompt request. `WorkflowJob`s reuse their template's
+    pre-encoded nodes, plain dicts are encoded in full.
+    """
+    if isinstance(prompt, WorkflowJob):
+        graph = prompt.encode()
+    else:
+        graph = _dumps(prompt)
+    return b'{"prompt":' + graph + b',"client_id":' + _dumps(client_id) + b"}"
 
 
 class Workflow:
     def __init__(self, workflow_path: str):
+        self.path = workflow_path
         self.data = self._load_workflow(workflow_path)
         self.original_state = self.data  # Keep copy of original state
+        self._compile()
 
     def _load_workflow(self, workflow_path: str):
         with open(workflow_path, "r", encoding="utf-8") as file:
@@ -20,7 +52,38 @@ class Workflow:
                 if k == isolate_node:
                     print(k, v)
 
-    def edit_workflow(
+    def _compile(self):
+        """
+        Index the graph once so that per-job edits don't have to scan it.
+
+        `_index` maps each class_type to its node keys in graph order, and `slots` maps
+        every `edit_workflow` parameter to the (node_key, input_name) pairs it fills.
+        `_encoded` holds every node already serialised as `"key":{...}` so jobs only
+        have to encode the nodes they override, and `digest` hashes them to identify
+        the graph's content.
+        """
+        self._index = {}
+        self._position = {}
+        self._encoded = []
+        for position, (k, v) in enumerate(self.data.items()):
+            self._index.setdefault(v["class_type"], []).append(k)
+            self._position[k] = position
+            self._encoded.append(_dumps(k) + b":" + _dumps(v))
+        self.digest = hashlib.sha256(b",".join(self._encoded)).hexdigest()
+
+        prompt_keys = self.node_keys(PROMPT_NODES)
+        image_keys = self.node_keys(IMAGE_NODES)
+        ksampler_keys = self.node_keys(KSAMPLER_NODES)
+        self.slots = {
+            "pos_prompt": [(k, "prompt") for k in prompt_keys[:1]],
+            "neg_prompt": [(k, "prompt") for k in prompt_keys[1:2]],
+            "image_path": [(k, "image") for k in image_keys[:1]],
+            "prefix": [(k, "filename_prefix") for k in self.node_keys(SAVE_NODES)],
+            "steps": [(k, "steps") for k in ksampler_keys[:1]],
+            "seed": [(k, "seed") for k in ksampler_keys[:1]],
+        }
+
+    def create_job(
         self,
         pos_prompt: str,
         neg_prompt: str,
@@ -28,59 +91,49 @@ class Workflow:
         prefix: str,
         steps: int = -1,
         seed: int = -1,
-    ):
-        new_workflow = self.data
-        ksampler_key = self._find_ksampler_node_key()
-        prompt_key = self._find_prompt_node_key()
-
-        if pos_prompt != "":
-            new_workflow = self.write_node_values(
-                new_workflow, prompt_key[0], pos_prompt, "prompt"
-            )
-        if neg_prompt != "":
-            new_workflow = self.write_node_values(
-                new_workflow, prompt_key[1], pos_prompt, "prompt"
-            )
-        if image_path != "":
-            image_key = self._find_image_node_key()
-            new_workflow = self.write_node_values(
-                new_workflow, node_key=image_key, value=image_path, value_key="image"
-            )
-
-        if prefix != "":
-            save_image_key = self._find_save_image_node_key()
-            if isinstance(save_image_key, str | int):
-                new_workflow = self.write_node_values(
-                    new_workflow,
-                    node_key=save_image_key,
-                    value=prefix,
-                    value_key="filename_prefix",
-                )
-            elif isinstance(save_image_key, list):
-                for n in save_image_key:
-                    new_workflow = self.write_node_values(
-                        new_workflow,
-                        node_key=n,
-                        value=prefix,
-                        value_key="filename_prefix",
-                    )
-
-        if steps != -1:
-            new_workflow = self.write_node_values(
-                new_workflow, node_key=ksampler_key, value=steps, value_key="steps"
-            )
-
-        if seed != -1:
-            new_workflow = self.write_node_values(
-                new_workflow, node_key=ksampler_key, value=seed, value_key="seed"
-            )
-        elif seed == -1:
+    ) -> "WorkflowJob":
+        """
+        Create a job that fills this template's slots. The template itself is left
+        untouched, the job only stores the inputs it overrides.
+        """
+        inputs = {
+            "pos_prompt": pos_prompt,
+            "neg_prompt": neg_prompt,
+            "image_path": image_path,
+            "prefix": prefix,
+            "steps": steps,
+            "seed": seed,
+        }
+        if seed == -1:
             seed = self._create_seed()
-            new_workflow = self.write_node_values(
-                new_workflow, node_key=ksampler_key, value=seed, value_key="seed"
-            )
+        values = {
+            "pos_prompt": pos_prompt if pos_prompt != "" else None,
+            "neg_prompt": neg_prompt if neg_prompt != "" else None,
+            "image_path": image_path if image_path != "" else None,
+            "prefix": prefix if prefix != "" else None,
+            "steps": steps if steps != -1 else None,
+            "seed": seed,
+        }
+
+        overrides = {}
+        for name, value in values.items():
+            if value is None:
+                continue
+            for node_key, value_key in self.slots[name]:
+                overrides.setdefault(node_key, {})[value_key] = value
+        return WorkflowJob(self, overrides, inputs=inputs)
 
-        return new_workflow
+    def edit_workflow(
+        self,
+        pos_prompt: str,
+        neg_prompt: str,
+        image_path: str,
+        prefix: str,
+        steps: int = -1,
+        seed: int = -1,
+    ) -> dict:
+        job = self.create_job(pos_prompt, neg_prompt, image_path, prefix, steps, seed)
+        return job.to_dict()
 
     def write_node_values(
         self, workflow_data: dict, node_key: str, value: str, value_key: str
@@ -99,16 +152,14 @@ class Workflow:
     ========================================================
     """
 
+    def node_keys(self, node_class: str | list) -> list:
+        if isinstance(node_class, str):
+            return list(self._index.get(node_class, []))
+        nodes = [k for c in node_class for k in self._index.get(c, [])]
+        return sorted(nodes, key=self._position.__getitem__)
+
     def _find_node_key(self, node_class: str):
-        nodes = []
-        for k1, v1 in self.data.items():
-            class_type = v1["class_type"]
-            if isinstance(node_class, str):
-                if class_type == node_class:
-                    nodes.append(k1)
-            elif isinstance(node_class, list):
-                if class_type in node_class:
-                    nodes.append(k1)
+        nodes = self.node_keys(node_class)
         if len(nodes) > 1:
             return nodes
         elif len(nodes) == 1:
@@ -117,20 +168,119 @@ class Workflow:
             return nodes
 
     def _find_image_node_key(self) -> str | list:
-        key = self._find_node_key("LoadImage")
+        key = self._find_node_key(IMAGE_NODES[0])
         return key
 
     def _find_save_image_node_key(self) -> str | list:
-        node_classes = ["SaveImage", "VHS_VideoCombine"]
-        key = self._find_node_key(node_classes)
+        key = self._find_node_key(SAVE_NODES)
         return key
 
     def _find_prompt_node_key(self):
-        node_classes = ["CLIPTextEncode", "TextEncodeQwenImageEdit"]
-        key = self._find_node_key(node_class=node_classes)
+        key = self._find_node_key(node_class=PROMPT_NODES)
         return key
 
     def _find_ksampler_node_key(self):
-        node_classes = ["KSampler", "KSamplerAdvanced"]
-        key = self._find_node_key(node_class=node_classes)
+        key = self._find_node_key(node_class=KSAMPLER_NODES)
         return key
+
+
+class WorkflowJob:
+    """
+    A single job on top of an immutable `Workflow` template.
+
+    Only the overridden inputs are stored ({node_key: {input_name: value}}), so creating
+    a job costs nothing proportional to the graph size and any number of jobs can be in
+    flight at once. The full graph is only assembled by `to_dict` when it is sent.
+
+    `inputs` keeps the arguments the job was created from, which identify the job
+    independently of its random seed (see `journal.job_key`).
+    """
+
+    def __init__(self, workflow: Workflow, overrides: dict, inputs: dict = None):
+        self.workflow = workflow
+        self.overrides = overrides
+        self.inputs = inputs
+
+    def __repr__(self):
+        return f"WorkflowJob({self.overrides})"
+
+    def get_input(self, node_key: str, value_key: str):
+        inputs = self.overrides.get(node_key, {})
+        if value_key in inputs:
+            return inputs[value_key]
+        return self.workflow.data[node_key]["inputs"].get(value_key)
+
+    def with_inputs(self, node_key: str, **inputs) -> "WorkflowJob":
+        """
+        Return a new job with more inputs of `node_key` overridden.
+        """
+        overrides = dict(self.overrides)
+        overrides[node_key] = {**overrides.get(node_key, {}), **inputs}
+        return WorkflowJob(self.workflow, overrides, inputs=self.inputs)
+
+    def to_dict(self) -> dict:
+        """
+        Merge the overrides into the template. Nodes that are not overridden are shared
+        with the template, so the result must not be modified in place.
+        """
+        data = dict(self.workflow.data)
+        for node_key, inputs in self.overrides.items():
+            data[node_key] = self._merged_node(node_key, inputs)
+        return data
+
+    def encode(self) -> bytes:
+        """
+        JSON-encode the merged graph. Only the overridden nodes are serialised, the rest
+        are spliced in from the template's cache.
+        """
+        pieces = list(self.workflow._encoded)
+        for node_key, inputs in self.overrides.items():
+            node = self._merged_node(node_key, inputs)
+            pieces[self.workflow._position[node_key]] = (
+                _dumps(node_key) + b":" + _dumps(node)
+            )
+        return b"{" + b",".join(pieces) + b"}"
+
+    def _merged_node(self, node_key: str, inputs: dict) -> dict:
+        node = dict(self.workflow.data[node_key])
+        node["inputs"] = {**node["inputs"], **inputs}
+        return node
+
+
+def benchmark_encode(workflow_path: str, jobs: int = 1000) -> dict:
+    """
+    Compare `json.dumps` of the merged graph against `WorkflowJob.encode` for `jobs`
+    jobs on the given workflow.
+
+    Returns
+    -------
+    dict
+        Seconds per job for both paths, the speedup and the backend in use.
+    """
+    workflow = Workflow(workflow_path)
+    batch = [
+        workflow.create_job(f"prompt {i}", "", f"frame_{i:05d}.png", "out")
+        for i in range(jobs)
+    ]
+
+    start = time.perf_counter()
+    for job in batch:
+        json.dumps({"prompt": job.to_dict(), "client_id": "benchmark"}).encode("utf-8")
+    plain = (time.perf_counter() - start) / jobs
+
+    start = time.perf_counter()
+    for job in batch:
+        encode_prompt(job, "benchmark")
+    cached = (time.perf_counter() - start) / jobs
+
+    return {
+        "nodes": len(workflow.data),
+        "json_dumps_s": plain,
+        "encode_s": cached,
+        "speedup": plain / cached,
+        "backend": "orjson" if orjson != None else "json",
+    }
+
+
+if __name__ == "__main__":
+    print(benchmark_encode(sys.argv[1]))